@@ -0,0 +1,236 @@
+import random
+
+import numpy as np
+from gymnasium import spaces
+from stable_baselines3.common.vec_env import VecEnv
+
+import utils_rs
+import map_w
+import env as e
+from observation import normalize, obs_scale
+from selfplay import OpponentService
+
+
+class BatchedShooterEnv(VecEnv):
+    """Runs `num_envs` ShooterEnv matches in one VecEnv.
+
+    Actions come in as a `(num_envs, 12)` array and observations, rewards and dones
+    go out as `(num_envs, ...)` arrays. Finished matches are reset automatically and
+    their last observation is stored in `infos[i]["terminal_observation"]`.
+
+    The matches live in a native `utils_rs.WorldBatch`, so each turn of a step (every
+    seat in order, see `env.play_step_iter`) is one call for all matches.
+    """
+
+    def __init__(
+        self,
+        num_envs,
+        render_mode=None,
+        start_model=None,
+        normalize_obs=False,
+        fov=utils_rs.OBS_FOV,
+        rays=utils_rs.OBS_RAYS,
+        random_spawns=False,
+        team_sizes=None,
+        spawns=None,
+        frame_skip=1,
+        ray_engine="march",
+    ):
+        assert (
+            render_mode is None
+            or render_mode in e.ShooterEnv.metadata["render_modes"]
+        )
+        self.render_mode = render_mode
+        self.window_size = 500
+
+        self.worlds = utils_rs.WorldBatch(
+            map_w.MAP, num_envs, fov, rays, team_sizes, spawns, ray_engine
+        )
+        bound = 1 if normalize_obs else 1000
+        super().__init__(
+            num_envs,
+            spaces.Box(-bound, bound, (self.worlds.obs_size,), np.float32),
+            spaces.Box(-100, 100, (12,)),
+        )
+
+        self.opponents = OpponentService(self.action_space, start_model)
+        self.obs_scale = obs_scale(self.worlds.world(0)) if normalize_obs else None
+        # See ShooterEnv; the spawns come from one generator, seeded by `seed()`.
+        self.spawn_cells = e.spawn_cells(map_w.MAP) if random_spawns else None
+        self.np_random = np.random.default_rng()
+        # See ShooterEnv; the repeated frames run in one `WorldBatch.repeat_all` call.
+        self.frame_skip = frame_skip
+        self.iters = np.zeros(num_envs, dtype=np.int64)
+        self.learners = np.zeros(num_envs, dtype=np.int64)
+
+        self._obs = np.zeros((num_envs,) + self.observation_space.shape, np.float32)
+        self._rewards = np.zeros(num_envs, np.float32)
+        self._dones = np.zeros(num_envs, bool)
+        self._actions = None
+        self.renderer = None
+
+    def _reset_world(self, i):
+        self.iters[i] = 0
+        self.learners[i] = random.randrange(self.worlds.num_players)
+        spawns = None
+        if self.spawn_cells is not None:
+            spawns = e.draw_spawns(self.np_random, self.spawn_cells, self.worlds.num_players)
+        self.worlds.reset(i, int(self.learners[i]), spawns)
+        self.opponents.new_episode(i)
+        self.worlds.observe(i, self._obs[i])
+        if self.obs_scale is not None:
+            normalize(self._obs[i], self.obs_scale, out=self._obs[i])
+
+    @property
+    def selfplay(self):
+        return self.opponents.policy
+
+    @selfplay.setter
+    def selfplay(self, policy):
+        self.opponents.policy = policy
+
+    def set_opponent_pool(self, pool):
+        self.opponents.pool = pool
+
+    def add_opponent(self, path):
+        self.opponents.pool.add(path)
+
+    def _opponent_actions(self, mask):
+        # Rows outside `mask` are never played.
+        actions = np.zeros((self.num_envs,) + self.action_space.shape, np.float32)
+        if mask.any():
+            actions[mask] = self.opponents.act(self._obs[mask], np.flatnonzero(mask))
+        return actions
+
+    def _play_turns(self, actions, active, observe):
+        self.worlds.step_all(
+            np.ascontiguousarray(actions, np.float32),
+            active.view(np.uint8),
+            observe.view(np.uint8),
+            self._rewards,
+            self._dones.view(np.uint8),
+            self._obs,
+        )
+        return self._turn_results(active & observe)
+
+    def _repeat_turns(self, seat_actions, active):
+        self.worlds.repeat_all(
+            seat_actions,
+            active.view(np.uint8),
+            self.frame_skip - 1,
+            self._rewards,
+            self._dones.view(np.uint8),
+            self._obs,
+        )
+        return self._turn_results(active)
+
+    def _turn_results(self, observed):
+        if self.obs_scale is not None:
+            # Only the observed rows and those of ended matches were rewritten.
+            self._obs[observed | self._dones] *= self.obs_scale
+        return self._rewards.copy(), self._dones.copy()
+
+    def reset_some(self, indices):
+        """Starts new matches in the worlds at `indices` and returns their observations."""
+        for i in indices:
+            self._reset_world(i)
+        return self._obs[indices].copy()
+
+    def reset(self):
+        if self._seeds[0] is not None:
+            self.np_random = np.random.default_rng(self._seeds[0])
+        for i in range(self.num_envs):
+            self._reset_world(i)
+        self._reset_seeds()
+        self._reset_options()
+        return self._obs.copy()
+
+    def step_async(self, actions):
+        self._actions = np.asarray(actions, np.float32)
+
+    def step_wait(self):
+        return self.step_some(self._actions, np.ones(self.num_envs, bool))
+
+    def step_some(self, actions, stepping):
+        """Steps only the matches in the mask `stepping`, with their rows of `actions`.
+
+        Returns the `step_wait` tuple for every match. The others are left as they
+        were: zero rewards, no dones, empty infos and unchanged observations.
+        """
+        self.iters[stepping] += self.frame_skip
+        capped = stepping & (self.iters > e.MAX_ITERS)
+        active = stepping & ~capped
+        rewards = np.zeros(self.num_envs, np.float32)
+        dones = np.zeros(self.num_envs, bool)
+        seat_actions = np.zeros(
+            (self.num_envs, self.worlds.num_players) + self.action_space.shape, np.float32
+        )
+
+        # Opponents moving before the learner in the first seats see the observation
+        # returned by the last step. After that a world is only observed for an opponent
+        # that acts on what it sees, and after the last seat for the step's result, unless
+        # the repeated frames that follow observe it anyway.
+        watching = self.opponents.observes(range(self.num_envs))
+        last = self.worlds.num_players - 1
+        for seat in range(self.worlds.num_players):
+            learning = self.learners == seat
+            turn = np.where(
+                learning[:, None], actions, self._opponent_actions(active & ~learning)
+            )
+            seat_actions[:, seat] = turn
+            if seat < last:
+                observe = watching & (self.learners != seat + 1)
+            else:
+                observe = np.full(self.num_envs, self.frame_skip == 1)
+            turn_rewards, turn_dones = self._play_turns(turn, active, observe)
+            rewards += turn_rewards
+            dones |= turn_dones
+            active &= ~turn_dones
+
+        if self.frame_skip > 1:
+            turn_rewards, turn_dones = self._repeat_turns(seat_actions, active)
+            rewards += turn_rewards
+            dones |= turn_dones
+
+        rewards[capped] = -100
+        dones[capped] = True
+
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(dones):
+            infos[i]["terminal_observation"] = self._obs[i].copy()
+            infos[i]["TimeLimit.truncated"] = False
+            self._reset_world(i)
+
+        return self._obs.copy(), rewards, dones, infos
+
+    def render_world(self, i):
+        utils = self.worlds.world(i)
+        if self.renderer is None:
+            self.renderer = e.make_renderer(utils, self.window_size)
+        return e.render_rgb_array(self.renderer, utils)
+
+    def get_images(self):
+        # Only the first match is drawn, which is all VecVideoRecorder needs.
+        return [self.render_world(0)] + [None] * (self.num_envs - 1)
+
+    def render(self, mode=None):
+        if self.render_mode == "rgb_array" and mode in (None, "rgb_array"):
+            # One image, as from SubprocShooterEnv; there is nothing to tile.
+            return self.render_world(0)
+        return super().render(mode)
+
+    def close(self):
+        pass
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        result = getattr(self, method_name)(*method_args, **method_kwargs)
+        return [result for _ in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._get_indices(indices)]
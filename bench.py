@@ -0,0 +1,211 @@
+"""Benchmarks for the simulator and environment hot paths.
+
+    python bench.py                         # all benchmarks, table on stdout
+    python bench.py --json results.json     # also write machine-readable results
+    python bench.py -k ray_fov --engines march dda
+    python bench.py -k observe --rays 45 90 180 360
+    python bench.py -k ray_fov --team-size 1 4 16
+
+Every benchmark is timed on freshly prepared worlds, so calls that change the world
+(ticks, moves) always start from the same state. Results are reported per call in
+microseconds.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import utils_rs
+import map_w
+import env as e
+
+
+SPAWNS = ((9, 11), (1, 1))
+
+
+def make_map(size, density=0.15, seed=0):
+    """A `size` x `size` map with a solid border, random inner walls and free spawns."""
+    if size is None:
+        return map_w.MAP
+
+    rng = random.Random(seed)
+    walls = [[0] * size for _ in range(size)]
+    for y in range(size):
+        for x in range(size):
+            border = x in (0, size - 1) or y in (0, size - 1)
+            if border or rng.random() < density:
+                walls[y][x] = 1
+
+    for x, y in SPAWNS:
+        walls[y][x] = 0
+    return walls
+
+
+def make_world(walls, engine, bullets=0, smokes=0, rays=utils_rs.OBS_RAYS, team_size=1):
+    """A match on `walls` between two teams of `team_size`, with up to `bullets` bullets
+    in flight and `smokes` open smokes."""
+    utils = utils_rs.Utils(walls, [team_size, team_size])
+    utils.ray_engine = engine
+    utils.set_view(utils_rs.OBS_FOV, rays)
+
+    for _ in range(smokes):
+        utils.fire_smoke()
+        utils.next_turn()
+    while any(not smoke.opened for smoke in utils.smokes):
+        utils.smoke_tick()
+
+    # Fan the shots out so they do not all hit the same wall on the first tick.
+    for i in range(bullets):
+        utils.set_rotation(i * 37 % 360)
+        utils.fire_bullet()
+        utils.next_turn()
+
+    return utils
+
+
+def measure(call, prepare, calls, repeat):
+    """Times `call(state)` over `calls` fresh states, `repeat` times.
+
+    Returns per-call times in seconds, one per repeat.
+    """
+    times = []
+    for _ in range(repeat):
+        states = [prepare() for _ in range(calls)]
+        start = time.perf_counter()
+        for state in states:
+            call(state)
+        times.append((time.perf_counter() - start) / calls)
+    return times
+
+
+def simulator_benchmarks(walls, engine, bullets, smokes, rays, team_size):
+    world = lambda: make_world(walls, engine, bullets, smokes, rays, team_size)
+    # The read-only calls do not need a fresh world each time.
+    shared = world()
+    same = lambda: shared
+
+    return {
+        # The map index is shared, so this is what a reset costs.
+        "Utils.new": (lambda walls: utils_rs.Utils(walls, [team_size, team_size]), lambda: walls),
+        "ray_fov": (lambda u: u.ray_fov(u.obs_fov, u.obs_rays), same),
+        # A fresh world casts from a pose it has not seen, so its walls are traced too.
+        "ray_fov:cold": (lambda u: u.ray_fov(u.obs_fov, u.obs_rays), world),
+        "observe_into": (lambda u: e.get_obs(u), same),
+        "bullet_tick": (lambda u: u.bullet_tick(), world),
+        "smoke_tick": (lambda u: u.smoke_tick(), world),
+        "flash_tick": (lambda u: u.flash_tick(), world),
+        "player_move": (lambda u: u.player_move(0.5, -0.5), world),
+        "get_players_hit_by_bullet": (lambda u: u.get_players_hit_by_bullet(), same),
+    }
+
+
+def env_benchmarks():
+    def make_env(render_mode=None, frame_skip=1):
+        env = e.ShooterEnv(render_mode=render_mode, frame_skip=frame_skip)
+        env.reset(seed=0)
+        return env
+
+    action = np.zeros(12, np.float32)
+    action[[2, 3, 5]] = 1
+    action[4] = 3
+
+    shared = make_env(render_mode="rgb_array")
+    return {
+        "env._get_obs": (lambda env: env._get_obs(), lambda: shared),
+        "env.step": (lambda env: env.step(action), make_env),
+        # Four frames per call, the last three played natively.
+        "env.step:frame_skip=4": (lambda env: env.step(action), lambda: make_env(frame_skip=4)),
+        "env._render_frame": (lambda env: env._render_frame(), lambda: shared),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks containing this")
+    parser.add_argument("--maps", nargs="+", default=["default", "25", "50"],
+                        help="'default' for map_w.MAP or the side of a generated map")
+    parser.add_argument("--engines", nargs="+", default=["dda", "march"])
+    parser.add_argument("--bullets", nargs="+", type=int, default=[0, 60])
+    parser.add_argument("--smokes", nargs="+", type=int, default=[0, 6])
+    parser.add_argument("--rays", nargs="+", type=int, default=[utils_rs.OBS_RAYS],
+                        help="rays per observation")
+    parser.add_argument("--team-size", nargs="+", type=int, default=[1],
+                        help="players on each of the two teams")
+    parser.add_argument("--calls", type=int, default=200, help="calls per repeat")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    cases = []
+    for map_name in args.maps:
+        walls = make_map(None if map_name == "default" else int(map_name))
+        grid = itertools.product(args.engines, args.bullets, args.smokes, args.rays, args.team_size)
+        for engine, bullets, smokes, rays, team_size in grid:
+            params = {
+                "map": map_name,
+                "engine": engine,
+                "bullets": bullets,
+                "smokes": smokes,
+                "rays": rays,
+                "team_size": team_size,
+            }
+            benches = simulator_benchmarks(walls, engine, bullets, smokes, rays, team_size)
+            for name, bench in benches.items():
+                cases.append((name, params, bench))
+    for name, bench in env_benchmarks().items():
+        cases.append((name, {"map": "default"}, bench))
+
+    results = []
+    for name, params, (call, prepare) in cases:
+        if args.filter not in name:
+            continue
+
+        times = measure(call, prepare, args.calls, args.repeat)
+        result = {
+            "name": name,
+            **params,
+            "calls": args.calls,
+            "repeat": args.repeat,
+            "mean_us": statistics.mean(times) * 1e6,
+            "median_us": statistics.median(times) * 1e6,
+            "min_us": min(times) * 1e6,
+        }
+        results.append(result)
+
+        label = " ".join(f"{key}={value}" for key, value in params.items())
+        print(f"{name:28} {label:58} {result['median_us']:12.1f} us")
+
+    if args.json:
+        report = {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "revision": git_revision(),
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
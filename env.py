@@ -1,93 +1,283 @@
 import numpy as np
-import pygame
 import random
-import math
 
 import gymnasium as gym
 from gymnasium import spaces
 
 import utils_rs
 import map_w
+from observation import normalize, obs_scale
+from profiler import NULL_PROFILER, StepProfiler
 
 
-def ang(x1, y1, x2, y2):
-    return math.degrees(math.atan2(-(y2 - y1), x2 - x1)) + 90 % 360
+MAX_ITERS = 1000
 
+# Packed entity rows written by `Utils.players_into` / `bullets_into` / ...
+PLAYER_DTYPE = np.dtype(
+    [
+        (name, np.float64)
+        for name in ("x", "y", "rotation", "ammo", "sound", "smokes", "flashes", "flashed")
+    ]
+)
+BULLET_DTYPE = np.dtype([(name, np.float64) for name in ("x", "y", "rotation", "fired_by")])
+SMOKE_DTYPE = np.dtype([(name, np.float64) for name in ("x", "y", "radius", "opened")])
+FLASH_DTYPE = np.dtype([(name, np.float64) for name in ("x", "y", "opened")])
 
-def distance_between_rot_and_ang(rot, r2):
-    ang_result = r2
-    distance = (ang_result - rot + 180) % 360 - 180
-    return abs(distance)
+
+def get_obs(utils, out=None):
+    if out is None:
+        out = np.empty(utils.obs_size, np.float32)
+    utils.observe_into(out)
+    return out
+
+
+def _entity_array(count, dtype, fill):
+    out = np.empty(count, dtype)
+    fill(out.view(np.float64))
+    return out
+
+
+def players_array(utils):
+    return _entity_array(utils.num_players, PLAYER_DTYPE, utils.players_into)
+
+
+def bullets_array(utils):
+    return _entity_array(utils.num_bullets, BULLET_DTYPE, utils.bullets_into)
+
+
+def smokes_array(utils):
+    return _entity_array(utils.num_smokes, SMOKE_DTYPE, utils.smokes_into)
+
+
+def flashes_array(utils):
+    return _entity_array(utils.num_flashes, FLASH_DTYPE, utils.flashes_into)
+
+
+def spawn_cells(walls):
+    """The `(x, y)` of every free cell of `walls`, where a player can spawn."""
+    return np.array(
+        [(x, y) for y, row in enumerate(walls) for x, cell in enumerate(row) if cell == 0],
+        np.float64,
+    )
+
+
+def draw_spawns(np_random, cells, count):
+    """`count` distinct spawns from `cells`, drawn with the generator `np_random`."""
+    return [tuple(cells[i]) for i in np_random.choice(len(cells), count, replace=False).tolist()]
+
+
+def process_action(utils, action, profiler=NULL_PROFILER):
+    with profiler.phase("tick"):
+        utils.bullet_tick()
+        utils.smoke_tick()
+        utils.flash_tick()
+
+    if action[2] > 0:  # should i move
+        utils.player_move(action[0], action[1])
+    if action[3] > 0:
+        utils.fire_bullet()
+    if action[5] > 0:
+        utils.set_rotation((utils.player_pose()[2] + action[4]) % 360)
+    if action[7] > 0:
+        utils.push_memory(action[8], action[9])
+    if action[10] > 0:
+        utils.fire_smoke()
+    if action[11] > 0:
+        utils.fire_flash()
+
+
+def play_step_iter(utils, action, learner, profiler=NULL_PROFILER, frame_skip=1):
+    """Generator form of `play_step` that leaves choosing the opponents' actions to the caller.
+
+    A step is one turn of every player in seat order, the learner playing seat
+    `learner`. It yields (None) whenever another player is to move, with the world set
+    up so that `get_obs(utils)` is that player's view, and expects their action to be
+    sent back. It returns `(reward, done)` as its StopIteration value. Driving many of
+    these side by side lets one batched policy call act for every opponent at once.
+
+    With `frame_skip`, every player then repeats its action for `frame_skip - 1` more
+    rounds in the native core, until the match ends.
+    """
+    teams = utils.teams
+    actions = np.empty((utils.num_players, 12), np.float32)
+    reward = 0
+    done = False
+
+    for seat in range(utils.num_players):
+        if seat == learner:
+            with profiler.phase("learner_action"):
+                process_action(utils, action, profiler)
+            with profiler.phase("step_reward"):
+                shaping, hits = utils.step_reward()
+            reward += shaping
+            actions[seat] = action
+        else:
+            opponent = yield
+            actions[seat] = opponent
+            with profiler.phase("opponent_action"):
+                process_action(utils, opponent, profiler)
+            with profiler.phase("hits"):
+                hits = utils.get_players_hit_by_bullet()
+        done = len(hits) > 0
+
+        if done:
+            # The match is decided by whether player 0's team was hit.
+            first_team_hit = any(teams[i] == teams[0] for i in hits)
+            if first_team_hit == (teams[learner] == teams[0]):
+                reward -= 100
+            else:
+                reward += 100
+
+            if seat == learner and utils.player_ammo() == utils.ammo_total:
+                reward -= 25
+
+        # A learner moving first that ends the match keeps the turn.
+        if not (done and seat == learner == 0):
+            utils.next_turn()
+        if done:
+            return reward, done
+
+    if frame_skip > 1:
+        with profiler.phase("repeat"):
+            repeated, done = utils.repeat_actions(actions, learner, frame_skip - 1)
+        reward += repeated
+
+    return reward, done
+
+
+def drive(steps, opponent_action, profiler=NULL_PROFILER):
+    """Runs a step generator to completion, answering it with `opponent_action()`."""
+    try:
+        next(steps)
+        while True:
+            with profiler.phase("opponent_policy"):
+                opponent = opponent_action()
+            steps.send(opponent)
+    except StopIteration as stop:
+        return stop.value
+
+
+def play_step(utils, action, learner, opponent_action, profiler=NULL_PROFILER):
+    """Plays one learner step of a match: the learner's `action` in seat `learner` and
+    every other player's turn around it.
+
+    `opponent_action` is called without arguments on each other player's turn, so it
+    sees the world as that player does at that point. Returns `(reward, done)` from the
+    learner's point of view.
+    """
+    return drive(play_step_iter(utils, action, learner, profiler), opponent_action, profiler)
+
+
+def make_renderer(utils, window_size, fps=None):
+    """A `render.FrameRenderer` for `utils`, or a `render.WindowRenderer` showing its
+    frames at `fps` frames per second when `fps` is given.
+
+    Rendering is imported here, so simulating never loads it (or pygame).
+    """
+    from render import FrameRenderer, WindowRenderer
+
+    renderer = FrameRenderer(
+        map_w.MAP,
+        window_size,
+        (utils.wall_width, utils.wall_height),
+        (utils.player_width, utils.player_height),
+    )
+    return renderer if fps is None else WindowRenderer(renderer, fps)
+
+
+def render_entities(renderer, utils):
+    return renderer.render(
+        players_array(utils), bullets_array(utils), smokes_array(utils), flashes_array(utils)
+    )
+
+
+def render_rgb_array(renderer, utils):
+    """Renders `utils` with a `FrameRenderer`, returning a frame the caller owns."""
+    return render_entities(renderer, utils).copy()
 
 
 class ShooterEnv(gym.Env):
     metadata = {"render_modes": ["human", "rgb_array"], "render_fps": 15}
 
-    def __init__(self, render_mode=None, start_model=None):
+    def __init__(
+        self,
+        render_mode=None,
+        start_model=None,
+        parallel_rays=False,
+        profile=False,
+        normalize_obs=False,
+        fov=utils_rs.OBS_FOV,
+        rays=utils_rs.OBS_RAYS,
+        random_spawns=False,
+        team_sizes=None,
+        spawns=None,
+        frame_skip=1,
+        ray_engine="march",
+    ):
         self.selfplay = start_model
+        # With `profile`, every step reports its per-phase times in `info["profile"]`
+        # and `profile_summary()` aggregates them.
+        self.profiler = StepProfiler() if profile else NULL_PROFILER
         self.window_size = 500
-        self.utils = utils_rs.Utils(map_w.MAP)
+        self.parallel_rays = parallel_rays
+        # The observation casts `rays` rays spread over `fov` degrees around the player.
+        self.fov = fov
+        self.rays = rays
+        # Teams of `team_sizes` players (one each by default) starting at `spawns`, see
+        # `utils_rs.Utils`. The learner plays a random seat and the opponent policy the
+        # others, teammates included.
+        self.team_sizes = team_sizes
+        self.spawns = spawns
+        # Each step plays `frame_skip` frames with the same actions; see play_step_iter.
+        # Episodes are still capped at MAX_ITERS frames.
+        self.frame_skip = frame_skip
+        # "march" or "dda", see `utils_rs.Utils.ray_engine`. Their ray distances differ,
+        # so checkpoints only work with the engine they were trained with.
+        self.ray_engine = ray_engine
+        self.utils = self._make_utils()
+        # With `random_spawns`, every episode spawns the players on free cells drawn
+        # from `np_random`, so `reset(seed=...)` makes them reproducible.
+        self.spawn_cells = spawn_cells(map_w.MAP) if random_spawns else None
         self.iters = 0
-        self.isp1 = random.random() > 0.5
+        self.learner = random.randrange(self.utils.num_players)
 
-        self.observation_space = spaces.Box(-1000, 1000, (388,))
+        # See observation.py for the layout; `normalize_obs` scales it into [-1, 1].
+        self.obs_scale = obs_scale(self.utils) if normalize_obs else None
+        bound = 1 if normalize_obs else 1000
+        self.observation_space = spaces.Box(-bound, bound, (self.utils.obs_size,), np.float32)
         self.action_space = spaces.Box(-100, 100, (12,))
 
         assert render_mode is None or render_mode in self.metadata["render_modes"]
         self.render_mode = render_mode
 
-        self.window = None
-        self.clock = None
+        self.renderer = None
+
+    def _make_utils(self):
+        utils = utils_rs.Utils(map_w.MAP, self.team_sizes, self.spawns)
+        utils.parallel_rays = self.parallel_rays
+        utils.ray_engine = self.ray_engine
+        utils.set_view(self.fov, self.rays)
+        return utils
+
+    def _spawns(self):
+        if self.spawn_cells is None:
+            return None
+        return draw_spawns(self.np_random, self.spawn_cells, self.utils.num_players)
 
     def _get_obs(self):
-        obs = []
-        ray_data = self.utils.ray_fov(90, 180)
-        for ray in ray_data:
-            if self.utils.players[self.utils.turn].flashed:
-                obs.extend([0, -1])
-            else:
-                obs.extend([ray[0], ray[1]])
-        obs.extend(
-            [
-                self.utils.players[self.utils.turn].x,
-                self.utils.players[self.utils.turn].y,
-                self.utils.players[self.utils.turn].rotation,
-                self.utils.players[self.utils.turn].ammo,
-            ]
-        )
-        for i in range(10):
-            if i < len(self.utils.players[self.utils.turn].memory_keys):
-                obs.extend(
-                    [
-                        self.utils.players[self.utils.turn].memory_keys[i],
-                        self.utils.players[self.utils.turn].memory_values[i],
-                    ]
-                )
-            else:
-                obs.extend(
-                    [
-                        0,
-                        0,
-                    ]
-                )
-        obs.extend(
-            [
-                self.utils.players[self.utils.turn].sound,
-                self.utils.players[self.utils.turn].smokes,
-                self.utils.players[self.utils.turn].flashes,
-                self.utils.players[self.utils.turn].flashed,
-            ]
-        )
-
-        return obs
+        with self.profiler.phase("get_obs"):
+            obs = get_obs(self.utils)
+            if self.obs_scale is not None:
+                normalize(obs, self.obs_scale, out=obs)
+            return obs
 
     def reset(self, seed=None, options=None):
         # We need the following line to seed self.np_random
         super().reset(seed=seed)
 
         self.iters = 0
-        self.utils = utils_rs.Utils(map_w.MAP)
-        self.isp1 = random.random() > 0.5
+        self.utils.reset(self._spawns())
+        self.learner = random.randrange(self.utils.num_players)
 
         observation = self._get_obs()
 
@@ -96,294 +286,83 @@ class ShooterEnv(gym.Env):
 
         return observation, {}
 
+    def snapshot(self):
+        """The state of the current episode, for `restore`.
+
+        Planners can branch from it many times: restoring copies the saved state back
+        into the existing world instead of rebuilding it.
+        """
+        return self.iters, self.learner, self.utils.snapshot()
+
+    def restore(self, snapshot):
+        self.iters, self.learner, state = snapshot
+        self.utils.restore(state)
+
     def process_action(self, action):
-        self.utils.bullet_tick()
-        self.utils.smoke_tick()
-        self.utils.flash_tick()
-
-        if action[2] > 0:  # should i move
-            self.utils.player_move(action[0], action[1])
-        if action[3] > 0:
-            self.utils.fire_bullet()
-        if action[5] > 0:
-            self.utils.set_rotation(
-                (self.utils.players[self.utils.turn].rotation + action[4]) % 360
-            )
-        if action[7] > 0:
-            mem_values = self.utils.players[self.utils.turn].memory_values
-            mem_keys = self.utils.players[self.utils.turn].memory_keys
-            mem_values.insert(0, action[9])
-            mem_keys.insert(0, action[8])
-            if len(mem_values) > 10:
-                mem_values.pop()
-                mem_keys.pop()
-            self.utils.set_memory_values(mem_values)
-            self.utils.set_memory_keys(mem_keys)
-        if action[10] > 0:
-            self.utils.fire_smoke()
-        if action[11] > 0:
-            self.utils.fire_flash()
+        process_action(self.utils, action, self.profiler)
+
+    def _opponent_action(self):
+        if self.selfplay is None:
+            return self.action_space.sample()
+        return self.selfplay.predict(self._get_obs())[0]
 
     def step(self, action):
-        self.iters += 1
-        reward = 0
+        return drive(self.step_iter(action), self._opponent_action, self.profiler)
+
+    def step_iter(self, action):
+        """Generator form of `step`, see `play_step_iter`.
+
+        While it is suspended, `_get_obs()` is the observation of the player to move. It returns the
+        usual `step` tuple as its StopIteration value.
+        """
+        self.iters += self.frame_skip
 
-        if self.iters > 1000:
+        if self.iters > MAX_ITERS:
             done = True
-            reward -= 100
+            reward = -100
         else:
-            if self.isp1:
-                self.process_action(action)
-
-                for bullet in self.utils.bullets:
-                    for i, player in enumerate(self.utils.players):
-                        if i != self.utils.turn:
-                            if (
-                                self.utils.distance(
-                                    bullet.x, bullet.y, player.x, player.y
-                                )
-                                <= 1
-                            ):
-                                reward += 5
-
-                for i, player in enumerate(self.utils.players):
-                    if i != self.utils.turn:
-                        if (
-                            distance_between_rot_and_ang(
-                                self.utils.players[self.utils.turn].rotation,
-                                ang(
-                                    self.utils.players[self.utils.turn].x,
-                                    self.utils.players[self.utils.turn].y,
-                                    player.x,
-                                    player.y,
-                                ),
-                            )
-                            <= 5
-                        ):
-                            reward += 5
-
-                if self.utils.players[self.utils.turn].ammo == 0:
-                    reward -= 5
-
-                hits = self.utils.get_players_hit_by_bullet()
-                done = len(hits) > 0
-
-                if not done:
-                    self.utils.next_turn()
-                    if self.selfplay is None:
-                        self.process_action(self.action_space.sample())
-                    else:
-                        self.process_action(self.selfplay.predict(self._get_obs()))
-                    hits = self.utils.get_players_hit_by_bullet()
-                    done = len(hits) > 0
-
-                    if done:
-                        if 0 in hits:
-                            reward -= 100
-                        else:
-                            reward += 100
-                    self.utils.next_turn()
-                else:
-                    if 0 in hits:
-                        reward -= 100
-                    else:
-                        reward += 100
-
-                    if (
-                        self.utils.players[self.utils.turn].ammo
-                        == self.utils.ammo_total
-                    ):
-                        reward -= 25
-            else:
-                if self.selfplay is None:
-                    self.process_action(self.action_space.sample())
-                else:
-                    self.process_action(self.selfplay.predict(self._get_obs()))
-
-                hits = self.utils.get_players_hit_by_bullet()
-                done = len(hits) > 0
-
-                self.utils.next_turn()
-
-                if not done:
-                    self.process_action(action)
-
-                    for bullet in self.utils.bullets:
-                        for i, player in enumerate(self.utils.players):
-                            if i != self.utils.turn:
-                                if (
-                                    self.utils.distance(
-                                        bullet.x, bullet.y, player.x, player.y
-                                    )
-                                    <= 1
-                                ):
-                                    reward += 5
-
-                    for i, player in enumerate(self.utils.players):
-                        if i != self.utils.turn:
-                            if (
-                                distance_between_rot_and_ang(
-                                    self.utils.players[self.utils.turn].rotation,
-                                    ang(
-                                        self.utils.players[self.utils.turn].x,
-                                        self.utils.players[self.utils.turn].y,
-                                        player.x,
-                                        player.y,
-                                    ),
-                                )
-                                <= 5
-                            ):
-                                reward += 5
-
-                    if self.utils.players[self.utils.turn].ammo == 0:
-                        reward -= 5
-
-                    hits = self.utils.get_players_hit_by_bullet()
-                    done = len(hits) > 0
-
-                    if done:
-                        if 0 in hits:
-                            reward += 100
-                        else:
-                            reward -= 100
-
-                        if (
-                            self.utils.players[self.utils.turn].ammo
-                            == self.utils.ammo_total
-                        ):
-                            reward -= 25
-                    self.utils.next_turn()
-                else:
-                    if 0 in hits:
-                        reward += 100
-                    else:
-                        reward -= 100
+            reward, done = yield from play_step_iter(
+                self.utils, action, self.learner, self.profiler, self.frame_skip
+            )
 
         observation = self._get_obs()
 
         if self.render_mode == "human":
             self._render_frame()
 
-        return observation, reward, done, False, {}
+        info = {}
+        if self.profiler is not NULL_PROFILER:
+            info["profile"] = self.profiler.end_step()
+
+        return observation, reward, done, False, info
+
+    def profile_summary(self):
+        """Per-phase calls and times over all profiled steps, or None when not profiling."""
+        if self.profiler is NULL_PROFILER:
+            return None
+        return self.profiler.summary()
 
     def render(self):
         if self.render_mode == "rgb_array":
             return self._render_frame()
 
     def _render_frame(self):
-        width_tile = round(self.window_size / len(map_w.MAP[0]) / self.utils.wall_width)
-        height_tile = round(self.window_size / len(map_w.MAP) / self.utils.wall_height)
-
-        if self.window is None and self.render_mode == "human":
-            pygame.init()
-            pygame.display.init()
-            self.window = pygame.display.set_mode((self.window_size, self.window_size))
-        if self.clock is None and self.render_mode == "human":
-            self.clock = pygame.time.Clock()
-
-        screen = pygame.Surface((self.window_size, self.window_size))
-        screen.fill((0, 0, 0))
-
-        for i, row in enumerate(map_w.MAP):
-            for j, col in enumerate(row):
-                if col == 1:
-                    pygame.draw.rect(
-                        screen,
-                        (255, 255, 255),
-                        pygame.Rect(
-                            j * width_tile * self.utils.wall_width,
-                            i * height_tile * self.utils.wall_height,
-                            width_tile * self.utils.wall_width,
-                            height_tile * self.utils.wall_height,
-                        ),
-                    )
-
-        for player in self.utils.players:
-            pygame.draw.rect(
-                screen,
-                (255, 0, 0) if not player.flashed else (0, 255, 0),
-                pygame.Rect(
-                    player.x * width_tile * self.utils.player_width,
-                    player.y * height_tile * self.utils.player_height,
-                    width_tile * self.utils.player_width,
-                    height_tile * self.utils.player_height,
-                ),
-            )
-            forward = self.utils.forward(player.rotation)
-            pygame.draw.line(
-                screen,
-                (255, 0, 0),
-                (
-                    player.x * width_tile * self.utils.player_width,
-                    player.y * height_tile * self.utils.player_height,
-                ),
-                (
-                    (player.x + forward[0] * 1.5)
-                    * width_tile
-                    * self.utils.player_width,
-                    (player.y + forward[1] * 1.5)
-                    * height_tile
-                    * self.utils.player_height,
-                ),
-            )
+        with self.profiler.phase("render"):
+            return self._draw_frame()
 
-        for smoke in self.utils.smokes:
-            if smoke.opened:
-                pygame.draw.circle(
-                    screen,
-                    (255, 255, 255),
-                    (
-                        smoke.x * width_tile,
-                        smoke.y * height_tile,
-                    ),
-                    smoke.radius * width_tile,
-                )
-            else:
-                pygame.draw.circle(
-                    screen,
-                    (255, 255, 255),
-                    (
-                        smoke.x * width_tile,
-                        smoke.y * height_tile,
-                    ),
-                    1,
-                )
-
-        for bullet in self.utils.bullets:
-            pygame.draw.circle(
-                screen,
-                (0, 0, 255),
-                (
-                    bullet.x * width_tile,
-                    bullet.y * height_tile,
-                ),
-                1,
-            )
+    def _draw_frame(self):
+        if self.renderer is None:
+            fps = self.metadata["render_fps"] if self.render_mode == "human" else None
+            self.renderer = make_renderer(self.utils, self.window_size, fps)
 
-        for flash in self.utils.flashes:
-            pygame.draw.circle(
-                screen,
-                (0, 255, 0),
-                (
-                    flash.x * width_tile,
-                    flash.y * height_tile,
-                ),
-                1,
-            )
+        if self.render_mode == "rgb_array":
+            return render_rgb_array(self.renderer, self.utils)
+        render_entities(self.renderer, self.utils)
 
-        if self.render_mode == "human":
-            # The following line copies our drawings from `canvas` to the visible window
-            self.window.blit(screen, screen.get_rect())
-            pygame.event.pump()
-            pygame.display.update()
-
-            # We need to ensure that human-rendering occurs at the predefined framerate.
-            # The following line will automatically add self.utils delay to keep the framerate stable.
-            self.clock.tick(self.metadata["render_fps"])
-        else:  # rgb_array
-            return np.transpose(
-                np.array(pygame.surfarray.pixels3d(screen)), axes=(1, 0, 2)
-            )
+    def close(self):
+        if self.renderer is not None:
+            self.renderer.close()
+            self.renderer = None
 
 
 """env = ShooterEnv(render_mode="human")
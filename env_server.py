@@ -0,0 +1,309 @@
+"""A process that hosts ShooterEnv matches for rollout actors in other processes.
+
+    python env_server.py --envs 256 --socket /tmp/airsoft.sock
+    python env_server.py --envs 256 --port 5555
+
+Actors connect with `EnvClient`, attach to some of the server's matches and step them
+with their own actions. Steps from every actor are gathered into one batched step of
+all the requested matches, which runs in a worker thread while the server keeps
+taking requests. Messages are pickled, so only serve trusted local clients.
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import pickle
+import struct
+
+import numpy as np
+
+import utils_rs
+from batched_env import BatchedShooterEnv
+
+
+_HEADER = struct.Struct("!I")
+
+
+async def _send(writer, message):
+    payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(_HEADER.pack(len(payload)) + payload)
+    await writer.drain()
+
+
+async def _receive(reader):
+    """The next message on `reader`, or None once the other side has closed."""
+    try:
+        (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+        return pickle.loads(await reader.readexactly(size))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class EnvServer:
+    """Serves the `num_envs` matches of a BatchedShooterEnv to `EnvClient`s.
+
+    A client attaches to a number of free matches (slots) and may reset and step only
+    those. A batch is stepped once every attached slot has an action waiting, or
+    `max_wait` seconds after the first one arrived. `env_kwargs` go to the
+    BatchedShooterEnv.
+    """
+
+    def __init__(self, num_envs, max_wait=0.002, **env_kwargs):
+        self.env = BatchedShooterEnv(num_envs, **env_kwargs)
+        self.env.reset()
+        self.max_wait = max_wait
+        self.batches = 0
+        self._free = list(range(num_envs))
+        self._attached = 0
+        self._pending = {}
+        self._arrived = None
+        self._lock = None
+        self._batcher = None
+
+    async def serve(self, path=None, host="127.0.0.1", port=0):
+        """Starts listening on the Unix socket `path`, or else on `host`:`port`.
+
+        Returns the asyncio server; with `port=0` the port picked is in its sockets.
+        """
+        self._arrived = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._batcher = asyncio.create_task(self._run_batches())
+        if path is not None:
+            return await asyncio.start_unix_server(self._serve_client, path)
+        return await asyncio.start_server(self._serve_client, host, port)
+
+    async def _serve_client(self, reader, writer):
+        slots = []
+        tasks = set()
+        try:
+            while (message := await _receive(reader)) is not None:
+                # Requests are answered as they complete, so a client can pipeline them.
+                task = asyncio.create_task(self._answer(writer, slots, *message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for slot in slots:
+                pending = self._pending.pop(slot, None)
+                if pending is not None:
+                    pending[1].cancel()
+            self._free.extend(slots)
+            self._attached -= len(slots)
+            writer.close()
+
+    async def _answer(self, writer, slots, request_id, command, args):
+        try:
+            result = await getattr(self, "_" + command)(slots, *args)
+        except Exception as error:
+            reply = (request_id, False, f"{type(error).__name__}: {error}")
+        else:
+            reply = (request_id, True, result)
+        await _send(writer, reply)
+
+    async def _attach(self, slots, count):
+        if count > len(self._free):
+            raise ValueError(f"{count} matches asked for, {len(self._free)} free")
+        new = [self._free.pop(0) for _ in range(count)]
+        slots.extend(new)
+        self._attached += count
+        return new, self.env.observation_space.shape[0]
+
+    def _check(self, slots, requested):
+        if not set(requested) <= set(slots):
+            raise ValueError("matches not attached to this client")
+
+    def _check_not_pending(self, requested):
+        pending = sorted(set(requested) & self._pending.keys())
+        if pending:
+            raise ValueError(f"matches {pending} are already being stepped")
+
+    async def _reset(self, slots, requested):
+        self._check(slots, requested)
+        self._check_not_pending(requested)
+        async with self._lock:
+            return self.env.reset_some(list(requested))
+
+    async def _step(self, slots, requested, actions):
+        # Every slot is checked before any is queued, so a refused step leaves none behind.
+        self._check(slots, requested)
+        repeated = sorted(slot for slot, n in collections.Counter(requested).items() if n > 1)
+        if repeated:
+            raise ValueError(f"matches {repeated} are stepped more than once")
+        self._check_not_pending(requested)
+        actions = np.asarray(actions, np.float32)
+        shape = (len(requested),) + self.env.action_space.shape
+        if actions.shape != shape:
+            raise ValueError(f"actions of shape {actions.shape} given, {shape} expected")
+        loop = asyncio.get_running_loop()
+        futures = []
+        for slot, action in zip(requested, actions):
+            future = loop.create_future()
+            self._pending[slot] = (action, future)
+            futures.append(future)
+        self._arrived.set()
+
+        results = await asyncio.gather(*futures)
+        obs, rewards, dones, infos = zip(*results)
+        return np.stack(obs), np.array(rewards), np.array(dones), list(infos)
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._arrived.wait()
+            deadline = loop.time() + self.max_wait
+            while len(self._pending) < self._attached and loop.time() < deadline:
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            self._arrived.clear()
+
+            batch, self._pending = self._pending, {}
+            batch = {slot: pending for slot, pending in batch.items() if not pending[1].done()}
+            if not batch:
+                continue
+
+            async with self._lock:
+                # A failing batch fails the steps in it, never the batcher.
+                try:
+                    stepping = np.zeros(self.env.num_envs, bool)
+                    actions = np.zeros(
+                        (self.env.num_envs,) + self.env.action_space.shape, np.float32
+                    )
+                    for slot, (action, _) in batch.items():
+                        stepping[slot] = True
+                        actions[slot] = action
+                    obs, rewards, dones, infos = await loop.run_in_executor(
+                        None, self.env.step_some, actions, stepping
+                    )
+                except Exception as error:
+                    for _, future in batch.values():
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+            self.batches += 1
+
+            for slot, (_, future) in batch.items():
+                if not future.done():
+                    future.set_result((obs[slot], rewards[slot], dones[slot], infos[slot]))
+
+
+class EnvClient:
+    """Asyncio client of an `EnvServer`.
+
+    Calls are pipelined: any number of actor coroutines can await calls on one client
+    at the same time, each for its own matches, and the server batches their steps.
+    Failed calls raise RuntimeError with the server's message.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count()
+        self._waiting = {}
+        self._listener = asyncio.create_task(self._listen())
+
+    @classmethod
+    async def connect(cls, path=None, host="127.0.0.1", port=None):
+        """Connects to the server on the Unix socket `path`, or else on `host`:`port`."""
+        if path is not None:
+            return cls(*await asyncio.open_unix_connection(path))
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._listener
+
+    async def _listen(self):
+        while (message := await _receive(self._reader)) is not None:
+            request_id, ok, result = message
+            future = self._waiting.pop(request_id)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+        for future in self._waiting.values():
+            future.set_exception(ConnectionError("the env server closed the connection"))
+        self._waiting.clear()
+
+    async def _call(self, command, *args):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = future
+        await _send(self._writer, (request_id, command, args))
+        return await future
+
+    async def attach(self, count):
+        """Takes `count` free matches of the server, returning `(slots, obs_size)`."""
+        return await self._call("attach", count)
+
+    async def reset(self, slots):
+        """Starts new matches in `slots` and returns their observations."""
+        return await self._call("reset", list(slots))
+
+    async def step(self, slots, actions):
+        """Steps the matches in `slots` with one action row each.
+
+        Returns `(obs, rewards, dones, infos)` for them, as a VecEnv step does; finished
+        matches are reset and their last observation is in the infos.
+        """
+        return await self._call("step", list(slots), np.asarray(actions, np.float32))
+
+
+def _spawn(text):
+    try:
+        x, y, rotation = map(float, text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected X,Y,ROTATION, got {text!r}") from None
+    return x, y, rotation
+
+
+async def _main(args):
+    server = EnvServer(
+        args.envs,
+        max_wait=args.max_wait,
+        fov=args.fov,
+        rays=args.rays,
+        random_spawns=args.random_spawns,
+        team_sizes=args.team_sizes,
+        spawns=args.spawns,
+        frame_skip=args.frame_skip,
+        ray_engine=args.ray_engine,
+    )
+    listener = await server.serve(args.socket, port=args.port)
+    address = args.socket or listener.sockets[0].getsockname()
+    print(f"serving {args.envs} matches on {address}", flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--envs", type=int, default=64, help="matches hosted")
+    parser.add_argument("--socket", help="Unix socket path to listen on")
+    parser.add_argument("--port", type=int, default=0, help="localhost port without --socket")
+    parser.add_argument("--max-wait", type=float, default=0.002,
+                        help="seconds a partial batch waits for more steps")
+    parser.add_argument("--fov", type=float, default=utils_rs.OBS_FOV)
+    parser.add_argument("--rays", type=int, default=utils_rs.OBS_RAYS)
+    parser.add_argument("--random-spawns", action="store_true")
+    parser.add_argument("--team-sizes", type=int, nargs="+", help="players per team")
+    parser.add_argument("--spawns", type=_spawn, nargs="+", metavar="X,Y,ROTATION",
+                        help="spawn of each player, in seat order")
+    parser.add_argument("--frame-skip", type=int, default=1, help="frames per step")
+    parser.add_argument("--ray-engine", choices=["march", "dda"], default="march")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Layout of the float32 observation written by `Utils.observe_into`.
+
+    index      field          meaning
+    0::2       ray_distance   distance to what each of the OBS_RAYS rays hit (0 when flashed)
+    1::2       ray_type       0 wall, 1 player, 2 smoke, 3 flashbang (-1 when flashed)
+    360        x
+    361        y
+    362        rotation       degrees
+    363        ammo
+    364::2     memory_key     MEMORY_SLOTS slots, newest first (0 when empty)
+    365::2     memory_value
+    384        sound
+    385        smokes         smokes left
+    386        flashes        flashbangs left
+    387        flashed        1 while blinded
+
+The ray fields interleave over the first `2 * OBS_RAYS` values and the memory fields
+over `2 * MEMORY_SLOTS`. `OBS_LAYOUT` maps each field name to the index or slice
+above; `obs_layout(rays)` does the same for envs built with another ray count, where
+every index from `x` on moves by `2 * (rays - OBS_RAYS)`.
+"""
+
+import math
+
+import numpy as np
+
+import utils_rs
+
+
+RAY_TYPES = ("wall", "player", "smoke", "flashbang")
+FLASHED = -1
+
+
+def obs_layout(rays=utils_rs.OBS_RAYS):
+    """Field name to index or slice, for observations with `rays` rays."""
+    memory = 2 * rays + 4
+    tail = memory + 2 * utils_rs.MEMORY_SLOTS
+    return {
+        "ray_distance": slice(0, 2 * rays, 2),
+        "ray_type": slice(1, 2 * rays, 2),
+        "x": 2 * rays,
+        "y": 2 * rays + 1,
+        "rotation": 2 * rays + 2,
+        "ammo": 2 * rays + 3,
+        "memory_key": slice(memory, tail, 2),
+        "memory_value": slice(memory + 1, tail, 2),
+        "sound": tail,
+        "smokes": tail + 1,
+        "flashes": tail + 2,
+        "flashed": tail + 3,
+    }
+
+
+def obs_size(rays=utils_rs.OBS_RAYS):
+    """Number of values in an observation with `rays` rays."""
+    return obs_layout(rays)["flashed"] + 1
+
+
+OBS_LAYOUT = obs_layout()
+assert obs_size() == utils_rs.OBS_SIZE
+
+
+def obs_scale(utils, action_limit=100):
+    """Per-value factors that bring an observation of `utils`' match into [-1, 1].
+
+    Distances are divided by the map diagonal, positions by the map size and counters
+    by their starting values. Memory and sound hold raw action values, bounded by
+    `action_limit`.
+    """
+    height, width = len(utils.walls), max(len(row) for row in utils.walls)
+    player = utils.players[0]
+    layout = obs_layout(utils.obs_rays)
+
+    scale = np.empty(utils.obs_size, np.float32)
+    scale[layout["ray_distance"]] = 1 / math.hypot(width, height)
+    scale[layout["ray_type"]] = 1 / (len(RAY_TYPES) - 1)
+    scale[layout["x"]] = 1 / width
+    scale[layout["y"]] = 1 / height
+    scale[layout["rotation"]] = 1 / 360
+    scale[layout["ammo"]] = 1 / utils.ammo_total
+    scale[layout["memory_key"]] = 1 / action_limit
+    scale[layout["memory_value"]] = 1 / action_limit
+    scale[layout["sound"]] = 1 / action_limit
+    scale[layout["smokes"]] = 1 / max(player.smokes, 1)
+    scale[layout["flashes"]] = 1 / max(player.flashes, 1)
+    scale[layout["flashed"]] = 1
+    return scale
+
+
+def normalize(obs, scale, out=None):
+    """`obs * scale` for one observation or a batch, written to `out` if given."""
+    return np.multiply(obs, scale, out=out)
+
+
+def ray_types(obs, rays=utils_rs.OBS_RAYS):
+    """The ray types of one observation or a batch as an int8 plane (`FLASHED` when blinded)."""
+    return np.asarray(obs)[..., obs_layout(rays)["ray_type"]].astype(np.int8)
+
+
+def ray_types_one_hot(obs, rays=utils_rs.OBS_RAYS):
+    """The ray types as a uint8 one-hot plane of shape `(..., rays, 1 + len(RAY_TYPES))`.
+
+    Column 0 marks rays hidden by a flashbang; column `1 + t` marks rays of type `t`.
+    """
+    return np.eye(1 + len(RAY_TYPES), dtype=np.uint8)[ray_types(obs, rays) + 1]
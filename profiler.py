@@ -0,0 +1,82 @@
+import time
+from collections import defaultdict
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+
+
+class StepProfiler:
+    """Wall time and call counts per phase of an env step.
+
+    Code under test wraps each phase in `with profiler.phase(name):`. Phases may nest, in
+    which case the outer phase includes the inner one. `end_step()` returns the times
+    of the step that just finished and `summary()` aggregates every step so far.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._step = defaultdict(float)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def record(self, name, seconds):
+        self.totals[name] += seconds
+        self.calls[name] += 1
+        self._step[name] += seconds
+
+    def end_step(self):
+        """Seconds spent in each phase since the previous `end_step()`."""
+        self.steps += 1
+        step, self._step = dict(self._step), defaultdict(float)
+        return step
+
+    def summary(self):
+        """Per phase: calls, total seconds, mean microseconds per call and per step."""
+        return {
+            name: {
+                "calls": self.calls[name],
+                "total_s": total,
+                "mean_us": total / self.calls[name] * 1e6,
+                "per_step_us": total / max(self.steps, 1) * 1e6,
+            }
+            for name, total in sorted(self.totals.items(), key=lambda item: -item[1])
+        }
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NullProfiler:
+    """Stands in for `StepProfiler` when profiling is off; records nothing."""
+
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+
+NULL_PROFILER = NullProfiler()
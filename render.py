@@ -0,0 +1,146 @@
+import math
+
+import numpy as np
+
+
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+BLUE = (0, 0, 255)
+
+
+class FrameRenderer:
+    """Draws ShooterEnv frames straight into a NumPy RGB buffer, without pygame.
+
+    The walls never change, so they are rasterised once into a background layer. Each
+    frame copies that layer into a reused `(size, size, 3)` uint8 buffer and draws the
+    players, smokes, bullets and flashes on top.
+    """
+
+    def __init__(self, walls, window_size, wall_size=(1, 1), player_size=(1, 1)):
+        self.window_size = window_size
+        self.wall_width, self.wall_height = wall_size
+        self.player_width, self.player_height = player_size
+        self.width_tile = round(window_size / len(walls[0]) / self.wall_width)
+        self.height_tile = round(window_size / len(walls) / self.wall_height)
+
+        self.background = np.zeros((window_size, window_size, 3), np.uint8)
+        self.background[:] = BLACK
+        cell_w = self.width_tile * self.wall_width
+        cell_h = self.height_tile * self.wall_height
+        for i, row in enumerate(walls):
+            for j, col in enumerate(row):
+                if col == 1:
+                    self._rect(self.background, j * cell_w, i * cell_h, cell_w, cell_h, WHITE)
+
+        self.frame = np.empty_like(self.background)
+        self._disks = {}
+
+    def render(self, players, bullets, smokes, flashes):
+        """Draws one frame from the structured entity arrays of `env.players_array` & co.
+
+        Returns the internal frame buffer, which the next call overwrites.
+        """
+        frame = self.frame
+        np.copyto(frame, self.background)
+
+        scale_x = self.width_tile * self.player_width
+        scale_y = self.height_tile * self.player_height
+        for player in players:
+            x, y = player["x"] * scale_x, player["y"] * scale_y
+            color = GREEN if player["flashed"] else RED
+            self._rect(frame, x, y, scale_x, scale_y, color)
+
+            rotation = math.radians(player["rotation"])
+            end_x = (player["x"] + math.sin(rotation) * 1.5) * scale_x
+            end_y = (player["y"] + math.cos(rotation) * 1.5) * scale_y
+            self._line(frame, x, y, end_x, end_y, RED)
+
+        for smoke in smokes:
+            radius = smoke["radius"] * self.width_tile if smoke["opened"] else 1
+            self._circle(
+                frame, smoke["x"] * self.width_tile, smoke["y"] * self.height_tile, radius, WHITE
+            )
+
+        for bullet in bullets:
+            self._circle(
+                frame, bullet["x"] * self.width_tile, bullet["y"] * self.height_tile, 1, BLUE
+            )
+
+        for flash in flashes:
+            self._circle(
+                frame, flash["x"] * self.width_tile, flash["y"] * self.height_tile, 1, GREEN
+            )
+
+        return frame
+
+    def close(self):
+        pass
+
+    def _rect(self, frame, x, y, width, height, color):
+        x, y = int(x), int(y)
+        left, top = max(x, 0), max(y, 0)
+        right = min(x + int(width), self.window_size)
+        bottom = min(y + int(height), self.window_size)
+        if left < right and top < bottom:
+            frame[top:bottom, left:right] = color
+
+    def _line(self, frame, x1, y1, x2, y2, color):
+        steps = int(max(abs(x2 - x1), abs(y2 - y1))) + 1
+        xs = np.rint(np.linspace(x1, x2, steps)).astype(np.int64)
+        ys = np.rint(np.linspace(y1, y2, steps)).astype(np.int64)
+        inside = (xs >= 0) & (xs < self.window_size) & (ys >= 0) & (ys < self.window_size)
+        frame[ys[inside], xs[inside]] = color
+
+    def _circle(self, frame, cx, cy, radius, color):
+        # Like pygame, circles are snapped to whole pixels, so each radius has one mask.
+        cx, cy, radius = int(cx), int(cy), max(int(radius), 1)
+        disk = self._disks.get(radius)
+        if disk is None:
+            offsets = np.arange(-radius, radius) + 0.5
+            disk = offsets[None, :] ** 2 + offsets[:, None] ** 2 <= radius**2
+            self._disks[radius] = disk
+
+        left, top = cx - radius, cy - radius
+        x0, y0 = max(-left, 0), max(-top, 0)
+        x1 = min(self.window_size - left, 2 * radius)
+        y1 = min(self.window_size - top, 2 * radius)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        # Masked copies are much faster one channel at a time than with an RGB mask.
+        region = frame[top + y0 : top + y1, left + x0 : left + x1]
+        for channel, value in enumerate(color):
+            np.copyto(region[..., channel], value, where=disk[y0:y1, x0:x1])
+
+
+class WindowRenderer:
+    """Shows the frames of a `FrameRenderer` in a pygame window, at most `fps` a second.
+
+    pygame is imported when the window opens, so nothing else in the package needs it.
+    """
+
+    def __init__(self, frames, fps):
+        import pygame
+
+        self.pygame = pygame
+        self.frames = frames
+        self.fps = fps
+        pygame.init()
+        pygame.display.init()
+        self.window = pygame.display.set_mode((frames.window_size, frames.window_size))
+        self.clock = pygame.time.Clock()
+
+    def render(self, players, bullets, smokes, flashes):
+        """Draws one frame like `FrameRenderer.render`, shows it and keeps to `fps`."""
+        frame = self.frames.render(players, bullets, smokes, flashes)
+        # Surfaces are indexed (x, y), frames (y, x).
+        self.pygame.surfarray.blit_array(self.window, frame.swapaxes(0, 1))
+        self.pygame.event.pump()
+        self.pygame.display.update()
+        self.clock.tick(self.fps)
+        return frame
+
+    def close(self):
+        self.pygame.display.quit()
@@ -0,0 +1,196 @@
+import random
+from collections import OrderedDict
+from copy import deepcopy
+
+import numpy as np
+from stable_baselines3.common.vec_env import DummyVecEnv
+
+
+class OpponentPool:
+    """Self-play opponents kept as checkpoint paths and loaded only when played.
+
+    `add` registers a new checkpoint and forgets the oldest beyond `max_checkpoints`.
+    `sample` picks the newest checkpoint with probability `latest_prob`, otherwise any
+    of them. `get` loads a checkpoint with `load(path)` on first use and keeps at most
+    `capacity` loaded policies, evicting the least recently used one.
+    """
+
+    def __init__(self, load, capacity=3, max_checkpoints=10, latest_prob=0.5, seed=None):
+        self.load = load
+        self.capacity = capacity
+        self.max_checkpoints = max_checkpoints
+        self.latest_prob = latest_prob
+        self.checkpoints = []
+        self.loaded = OrderedDict()
+        self.rng = random.Random(seed)
+
+    def __len__(self):
+        return len(self.checkpoints)
+
+    def __getstate__(self):
+        # Copies sent to worker processes start with nothing loaded and their own
+        # random stream, so workers do not all draw the same opponents.
+        state = self.__dict__.copy()
+        state["loaded"] = OrderedDict()
+        state["rng"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rng = random.Random()
+
+    def add(self, path):
+        self.checkpoints.append(path)
+        if len(self.checkpoints) > self.max_checkpoints:
+            self.loaded.pop(self.checkpoints.pop(0), None)
+
+    def sample(self):
+        """A checkpoint path to play against, or None while the pool is empty."""
+        if not self.checkpoints:
+            return None
+        if self.rng.random() < self.latest_prob:
+            return self.checkpoints[-1]
+        return self.rng.choice(self.checkpoints)
+
+    def get(self, path):
+        policy = self.loaded.get(path)
+        if policy is None:
+            policy = self.load(path)
+            self.loaded[path] = policy
+            if len(self.loaded) > self.capacity:
+                self.loaded.popitem(last=False)
+        else:
+            self.loaded.move_to_end(path)
+        return policy
+
+
+class OpponentService:
+    """Picks self-play opponent actions for a batch of observations in one call.
+
+    With no policy the opponent acts randomly. Otherwise one `policy.predict` runs over
+    the whole batch, so N waiting opponents cost one forward pass instead of N.
+
+    With a `pool` (an `OpponentPool`), every env slot plays the checkpoint it sampled in
+    `new_episode` until its next episode, and the batch is split into one predict per
+    checkpoint in play. `policy` is used for slots whose pool was still empty.
+    """
+
+    def __init__(self, action_space, policy=None, deterministic=False, pool=None):
+        self.action_space = action_space
+        self.policy = policy
+        self.deterministic = deterministic
+        self.pool = pool
+        self.slots = {}
+
+    def new_episode(self, slot):
+        if self.pool is not None:
+            self.slots[slot] = self.pool.sample()
+
+    def observes(self, slots):
+        """Mask of the `slots` whose opponent acts on its observations, not at random."""
+        if self.pool is None:
+            return np.full(len(slots), self.policy is not None)
+        return np.array(
+            [self.policy is not None or self.slots.get(slot) is not None for slot in slots], bool
+        )
+
+    def act(self, observations, slots=None):
+        """Actions for a `(n, obs_size)` batch of opponent observations, as `(n, 12)`.
+
+        `slots` are the env indices the observations come from; needed with a pool.
+        """
+        observations = np.asarray(observations, np.float32)
+        if self.pool is None or slots is None:
+            return self._predict(self.policy, observations)
+
+        checkpoints = [self.slots.get(slot) for slot in slots]
+        actions = np.empty((len(observations),) + self.action_space.shape, np.float32)
+        for checkpoint in dict.fromkeys(checkpoints):
+            rows = [i for i, other in enumerate(checkpoints) if other == checkpoint]
+            policy = self.policy if checkpoint is None else self.pool.get(checkpoint)
+            actions[rows] = self._predict(policy, observations[rows])
+        return actions
+
+    def _predict(self, policy, observations):
+        if policy is None:
+            return np.array(
+                [self.action_space.sample() for _ in range(len(observations))],
+                dtype=self.action_space.dtype,
+            ).reshape((len(observations),) + self.action_space.shape)
+
+        actions, _ = policy.predict(observations, deterministic=self.deterministic)
+        return actions
+
+
+class SelfPlayVecEnv(DummyVecEnv):
+    """DummyVecEnv of ShooterEnvs whose opponents share one batched policy call.
+
+    Each sub-env is stepped with `ShooterEnv.step_iter` up to the point where its
+    opponent must act. The observations of every waiting opponent then go through one
+    `OpponentService.act` call. The sub-envs must be bare ShooterEnvs (monitor at the
+    VecEnv level with VecMonitor), since gymnasium wrappers only forward `step`.
+
+    `selfplay` is the opponent policy for all sub-envs (None for random opponents);
+    set `opponents.pool` to an `OpponentPool` to sample one per episode instead.
+    """
+
+    def __init__(self, env_fns, start_model=None):
+        super().__init__(env_fns)
+        self.opponents = OpponentService(self.action_space, start_model)
+
+    @property
+    def selfplay(self):
+        return self.opponents.policy
+
+    @selfplay.setter
+    def selfplay(self, policy):
+        self.opponents.policy = policy
+
+    def reset(self):
+        for env_idx in range(self.num_envs):
+            self.opponents.new_episode(env_idx)
+        return super().reset()
+
+    def step_wait(self):
+        steps = {}
+        results = {}
+        for env_idx in range(self.num_envs):
+            steps[env_idx] = self.envs[env_idx].step_iter(self.actions[env_idx])
+
+        # As in ShooterEnv, only opponents that act on what they see are observed for;
+        # casting the rays costs time and can flash the viewer.
+        placeholder = np.zeros(self.observation_space.shape, self.observation_space.dtype)
+        waiting = self._advance(steps, results, dict.fromkeys(steps))
+        while waiting:
+            observations = [
+                self.envs[env_idx]._get_obs() if observed else placeholder
+                for env_idx, observed in zip(waiting, self.opponents.observes(waiting))
+            ]
+            actions = self.opponents.act(observations, waiting)
+            waiting = self._advance(steps, results, dict(zip(waiting, actions)))
+
+        for env_idx in range(self.num_envs):
+            obs, self.buf_rews[env_idx], terminated, truncated, self.buf_infos[env_idx] = results[env_idx]
+            # convert to SB3 VecEnv api
+            self.buf_dones[env_idx] = terminated or truncated
+            self.buf_infos[env_idx]["TimeLimit.truncated"] = truncated and not terminated
+
+            if self.buf_dones[env_idx]:
+                # save final observation where user can get it, then reset
+                self.buf_infos[env_idx]["terminal_observation"] = obs
+                obs, self.reset_infos[env_idx] = self.envs[env_idx].reset()
+                self.opponents.new_episode(env_idx)
+            self._save_obs(env_idx, obs)
+        return (self._obs_from_buf(), np.copy(self.buf_rews), np.copy(self.buf_dones), deepcopy(self.buf_infos))
+
+    @staticmethod
+    def _advance(steps, results, sends):
+        """Resumes each step in `sends` with its value and returns those that wait again."""
+        waiting = []
+        for env_idx, value in sends.items():
+            try:
+                steps[env_idx].send(value)
+                waiting.append(env_idx)
+            except StopIteration as stop:
+                results[env_idx] = stop.value
+        return waiting
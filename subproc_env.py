@@ -0,0 +1,236 @@
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+from gymnasium import spaces
+from stable_baselines3.common.vec_env import VecEnv
+
+import utils_rs
+from batched_env import BatchedShooterEnv
+from observation import obs_size
+
+
+# What the fork server imports before forking any worker, so workers start with the env
+# (and stable-baselines3 under it) already loaded. `__main__` is the launching script.
+FORKSERVER_PRELOAD = ["__main__", "batched_env"]
+
+
+def _buffer_specs(num_envs, rays):
+    return {
+        "obs": ((num_envs, obs_size(rays)), np.float32),
+        "actions": ((num_envs, 12), np.float32),
+        "rewards": ((num_envs,), np.float32),
+        "dones": ((num_envs,), bool),
+    }
+
+
+def _attach(blocks, specs, lo, hi):
+    return {
+        name: np.ndarray(shape, dtype, buffer=blocks[name].buf)[lo:hi]
+        for name, (shape, dtype) in specs.items()
+    }
+
+
+def _worker(remote, parent_remote, block_names, num_envs, lo, hi, env_kwargs):
+    parent_remote.close()
+    # The workers already use every core between them, so each keeps to one thread:
+    # rayon's pool (for `WorldBatch`) is sized on first use, and torch runs the opponents.
+    os.environ["RAYON_NUM_THREADS"] = "1"
+    torch.set_num_threads(1)
+    blocks = {name: shared_memory.SharedMemory(name=block) for name, block in block_names.items()}
+    buffers = _attach(blocks, _buffer_specs(num_envs, env_kwargs["rays"]), lo, hi)
+    env = BatchedShooterEnv(hi - lo, **env_kwargs)
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                obs, rewards, dones, infos = env.step(buffers["actions"])
+                buffers["obs"][:] = obs
+                buffers["rewards"][:] = rewards
+                buffers["dones"][:] = dones
+                remote.send(infos)
+            elif cmd == "reset":
+                if data is not None:
+                    env.seed(data)
+                buffers["obs"][:] = env.reset()
+                remote.send(None)
+            elif cmd == "render":
+                remote.send(env.render_world(data))
+            elif cmd == "get_attr":
+                remote.send(env.get_attr(data))
+            elif cmd == "set_attr":
+                remote.send(env.set_attr(*data))
+            elif cmd == "call":
+                name, args, kwargs = data
+                remote.send(getattr(env, name)(*args, **kwargs))
+            elif cmd == "close":
+                break
+            else:
+                raise NotImplementedError(f"`{cmd}` is not implemented in the worker")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        buffers.clear()
+        for block in blocks.values():
+            block.close()
+        remote.close()
+
+
+class SubprocShooterEnv(VecEnv):
+    """Runs `num_envs` matches split over `num_workers` processes.
+
+    Each worker hosts a `BatchedShooterEnv` for its share of the matches. Actions,
+    observations, rewards and dones go through shared memory, so a step only sends a
+    command and the infos over each pipe. Only the first match is rendered, which is
+    all `VecVideoRecorder` needs.
+
+    Workers are started with `start_method`, by default "forkserver" where there is
+    one and "spawn" elsewhere, so scripts using it need an `if __name__ == "__main__":`
+    guard. With "forkserver" the imports in FORKSERVER_PRELOAD are done once, in the
+    fork server, and each worker is forked from it in milliseconds. Avoid "fork": a
+    child forked after the parent has stepped a `BatchedShooterEnv` inherits rayon's
+    thread pool without its threads and hangs on its first step.
+    """
+
+    def __init__(
+        self,
+        num_envs,
+        num_workers,
+        render_mode=None,
+        start_model=None,
+        start_method=None,
+        normalize_obs=False,
+        fov=utils_rs.OBS_FOV,
+        rays=utils_rs.OBS_RAYS,
+        random_spawns=False,
+        team_sizes=None,
+        spawns=None,
+        frame_skip=1,
+        ray_engine="march",
+    ):
+        num_workers = max(1, min(num_workers, num_envs))
+        env_kwargs = dict(
+            render_mode=render_mode,
+            start_model=start_model,
+            normalize_obs=normalize_obs,
+            fov=fov,
+            rays=rays,
+            random_spawns=random_spawns,
+            team_sizes=team_sizes,
+            spawns=spawns,
+            frame_skip=frame_skip,
+            ray_engine=ray_engine,
+        )
+
+        specs = _buffer_specs(num_envs, rays)
+        self._blocks = {
+            name: shared_memory.SharedMemory(
+                create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            )
+            for name, (shape, dtype) in specs.items()
+        }
+        self._buffers = _attach(self._blocks, specs, 0, num_envs)
+
+        bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+        self._slices = list(zip(bounds[:-1], bounds[1:]))
+
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(start_method)
+        if ctx.get_start_method() == "forkserver":
+            # Only takes effect before the fork server has been started.
+            ctx.set_forkserver_preload(FORKSERVER_PRELOAD)
+        block_names = {name: block.name for name, block in self._blocks.items()}
+        self.remotes, self.processes = [], []
+        for lo, hi in self._slices:
+            remote, work_remote = ctx.Pipe()
+            args = (work_remote, remote, block_names, num_envs, lo, hi, env_kwargs)
+            process = ctx.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+        self.closed = False
+        # As in BatchedShooterEnv, normalized observations are in [-1, 1].
+        bound = 1 if normalize_obs else 1000
+        super().__init__(
+            num_envs,
+            spaces.Box(-bound, bound, (obs_size(rays),), np.float32),
+            spaces.Box(-100, 100, (12,)),
+        )
+
+    def _broadcast(self, cmd, data=None):
+        for remote in self.remotes:
+            remote.send((cmd, data))
+        return [remote.recv() for remote in self.remotes]
+
+    def reset(self):
+        # Each worker seeds its matches from the seed of its first one.
+        for remote, (lo, _) in zip(self.remotes, self._slices):
+            remote.send(("reset", self._seeds[lo]))
+        for remote in self.remotes:
+            remote.recv()
+        self._reset_seeds()
+        self._reset_options()
+        return self._buffers["obs"].copy()
+
+    def step_async(self, actions):
+        self._buffers["actions"][:] = actions
+        for remote in self.remotes:
+            remote.send(("step", None))
+
+    def step_wait(self):
+        infos = [info for remote in self.remotes for info in remote.recv()]
+        return (
+            self._buffers["obs"].copy(),
+            self._buffers["rewards"].copy(),
+            self._buffers["dones"].copy(),
+            infos,
+        )
+
+    def get_images(self):
+        self.remotes[0].send(("render", 0))
+        return [self.remotes[0].recv()]
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self._buffers.clear()
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self.closed = True
+
+    def call_workers(self, name, *args, **kwargs):
+        """Calls method `name` of every worker's BatchedShooterEnv, returning the results."""
+        return self._broadcast("call", (name, args, kwargs))
+
+    def set_opponent_pool(self, pool):
+        self.call_workers("set_opponent_pool", pool)
+
+    def add_opponent(self, path):
+        self.call_workers("add_opponent", path)
+
+    def get_attr(self, attr_name, indices=None):
+        values = [value for values in self._broadcast("get_attr", attr_name) for value in values]
+        return [values[i] for i in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        self._broadcast("set_attr", (attr_name, value))
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        results = self._broadcast("call", ("env_method", (method_name,) + method_args, method_kwargs))
+        results = [result for values in results for result in values]
+        return [results[i] for i in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._get_indices(indices)]
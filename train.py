@@ -1,11 +1,12 @@
 from stable_baselines3 import PPO
-from stable_baselines3.common.monitor import Monitor
-from stable_baselines3.common.vec_env import DummyVecEnv, VecVideoRecorder
-import wandb
-from wandb.integration.sb3 import WandbCallback
+from stable_baselines3.common.vec_env import VecMonitor, VecVideoRecorder
 import time
+import os
+from functools import partial
 
-import env as e
+from batched_env import BatchedShooterEnv
+from selfplay import OpponentPool
+from subproc_env import SubprocShooterEnv
 
 config = {
     "policy_type": "MlpPolicy",
@@ -13,64 +14,77 @@ config = {
     "env_name": "Airsoft",
 }
 
-run = wandb.init(
-    project="AirsoftAI",
-    config=config,
-    sync_tensorboard=True,
-    monitor_gym=True,
-    save_code=True
-)
-
-import random
-from collections import deque
-import os
-
 models_dir = "models/PPO"
 
-if not os.path.exists(models_dir):
-    os.makedirs(models_dir)
-
 TIMESTEPS = 50_000
+# Matches are spread over NUM_WORKERS processes; with one worker they run in-process.
+NUM_WORKERS = os.cpu_count() or 1
+NUM_ENVS = 8 * NUM_WORKERS
+# A PPO rollout collects about ROLLOUT_STEPS steps however many matches there are, so
+# the training budget and checkpoint cadence do not depend on the machine.
+ROLLOUT_STEPS = 8 * 2048
+N_STEPS = max(ROLLOUT_STEPS // NUM_ENVS, 1)
+
 
 def make_env():
-    env = e.ShooterEnv(render_mode="rgb_array")
-    env = Monitor(env)
-    return env
-
-env = DummyVecEnv([make_env])
-env = VecVideoRecorder(
-    env,
-    f"videos/{run.id}",
-    record_video_trigger=lambda x: x % 10000 == 0,
-    video_length=300,
-)
-
-model = PPO('MlpPolicy', env, verbose=2, tensorboard_log=f"runs/${run.id}")
-'''custom = {
-    "tensorboard_log": f"runs/${run.id}"
-}
-model = PPO.load("models\\u3jcd8tv\\model.zip", env, custom_objects=custom)'''
+    if NUM_WORKERS > 1:
+        return SubprocShooterEnv(NUM_ENVS, NUM_WORKERS, render_mode="rgb_array")
+    return BatchedShooterEnv(NUM_ENVS, render_mode="rgb_array")
+
 
-models = deque([], 10)
+def main():
+    # wandb is only needed here, not by the workers, which import this script too.
+    import wandb
+    from wandb.integration.sb3 import WandbCallback
 
-for i in range(25):
-    model.learn(total_timesteps=TIMESTEPS, reset_num_timesteps=False, callback=
-        WandbCallback(
-            gradient_save_freq=100,
-            model_save_path=f"models/{run.id}",
-            verbose=2,
-        ),
+    run = wandb.init(
+        project="AirsoftAI",
+        config=config,
+        sync_tensorboard=True,
+        monitor_gym=True,
+        save_code=True
     )
-    t = time.time()
-    model.save(f"{models_dir}/{t}")
-    print("SAVED")
-    models.append(PPO.load(f"{models_dir}/{t}", env))
 
-    if random.random() <= 0.5:
-        env.selfplay = models[-1]
-    else:
-        env.selfplay = random.choice(models)
+    if not os.path.exists(models_dir):
+        os.makedirs(models_dir)
+
+    env = make_env()
+    env = VecMonitor(env)
+    env = VecVideoRecorder(
+        env,
+        f"videos/{run.id}",
+        record_video_trigger=lambda x: x % 10000 == 0,
+        video_length=300,
+    )
+
+    model = PPO('MlpPolicy', env, n_steps=N_STEPS, verbose=2, tensorboard_log=f"runs/${run.id}")
+    '''custom = {
+        "tensorboard_log": f"runs/${run.id}"
+    }
+    model = PPO.load("models\\u3jcd8tv\\model.zip", env, custom_objects=custom)'''
+
+    # Past checkpoints are only loaded when an episode draws them as its opponent. The
+    # pool is handed to the env (and its workers) through the wrappers.
+    env.set_opponent_pool(
+        OpponentPool(partial(PPO.load, device="cpu"), capacity=3, max_checkpoints=10)
+    )
+
+    for i in range(25):
+        model.learn(total_timesteps=TIMESTEPS, reset_num_timesteps=False, callback=
+            WandbCallback(
+                gradient_save_freq=100,
+                model_save_path=f"models/{run.id}",
+                verbose=2,
+            ),
+        )
+        t = time.time()
+        model.save(f"{models_dir}/{t}")
+        print("SAVED")
+        env.add_opponent(f"{models_dir}/{t}")
+
+    env.close()
+    run.finish()
 
-    print(env.selfplay, models)
 
-run.finish()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,630 @@
-use libm::{cos, fabs, pow, sin, sqrt};
+use libm::{atan2, ceil, cos, fabs, floor, pow, round, sin, sqrt};
+use pyo3::buffer::{Element, PyBuffer};
+use pyo3::exceptions::{PyIndexError, PyValueError};
 use pyo3::prelude::*;
+use rayon::prelude::*;
+use std::collections::VecDeque;
+use std::sync::{Arc, Mutex, OnceLock, Weak};
+
+const OBS_FOV: f64 = 90.0;
+const OBS_RAYS: usize = 180;
+const MEMORY_SLOTS: usize = 10;
+const OBS_SIZE: usize = obs_size(OBS_RAYS);
+
+const fn obs_size(rays: usize) -> usize {
+    rays * 2 + 4 + MEMORY_SLOTS * 2 + 4
+}
+
+const ACTION_SIZE: usize = 12;
+
+fn check_buffer<T: Element>(buffer: &PyBuffer<T>, len: usize) -> PyResult<()> {
+    if !buffer.is_c_contiguous() {
+        return Err(PyValueError::new_err("buffer must be C-contiguous"));
+    }
+    if buffer.item_count() != len {
+        return Err(PyValueError::new_err(format!(
+            "buffer must hold {} values, got {}",
+            len,
+            buffer.item_count()
+        )));
+    }
+
+    Ok(())
+}
+
+// The buffers stay exported (and so cannot be resized or freed) for as long as the
+// `PyBuffer` is alive, which bounds the lifetime of the returned slices.
+
+fn buffer_as_slice<'a, T: Element>(buffer: &'a PyBuffer<T>, len: usize) -> PyResult<&'a [T]> {
+    check_buffer(buffer, len)?;
+    Ok(unsafe { std::slice::from_raw_parts(buffer.buf_ptr() as *const T, len) })
+}
+
+fn buffer_as_mut_slice<'a, T: Element>(buffer: &'a PyBuffer<T>, len: usize) -> PyResult<&'a mut [T]> {
+    if buffer.readonly() {
+        return Err(PyValueError::new_err("buffer is read-only"));
+    }
+    check_buffer(buffer, len)?;
+    Ok(unsafe { std::slice::from_raw_parts_mut(buffer.buf_ptr() as *mut T, len) })
+}
+
+/// Writes one `N`-value row per item into `buffer`, which must hold exactly
+/// `items.len() * N` float64 values.
+fn write_rows<T, const N: usize>(buffer: &PyAny, items: &[T], row: impl Fn(&T) -> [f64; N]) -> PyResult<()> {
+    let buffer = PyBuffer::<f64>::get(buffer)?;
+    let out = buffer_as_mut_slice(&buffer, items.len() * N)?;
+    for (chunk, item) in out.chunks_exact_mut(N).zip(items) {
+        chunk.copy_from_slice(&row(item));
+    }
+    Ok(())
+}
+
+/// Indices of the wall cells (of size `cell`) whose origin lies within `[lo, hi]`,
+/// clamped to a row or column of `len` cells.
+fn wall_cells(lo: f64, hi: f64, cell: u8, len: usize) -> std::ops::Range<usize> {
+    let start = floor(lo / cell as f64).max(0.0);
+    let end = (ceil(hi / cell as f64) + 1.0).min(len as f64);
+
+    if !(start < end) {
+        return 0..0;
+    }
+
+    start as usize..end as usize
+}
+
+/// Entry and exit times of the ray `o + t * d` through the open box of half extents
+/// `(hx, hy)` around `(cx, cy)`, or `None` if the ray misses it.
+fn ray_box(ox: f64, oy: f64, dx: f64, dy: f64, cx: f64, cy: f64, hx: f64, hy: f64) -> Option<(f64, f64)> {
+    let mut enter = f64::NEG_INFINITY;
+    let mut exit = f64::INFINITY;
+
+    for (o, d, c, h) in [(ox, dx, cx, hx), (oy, dy, cy, hy)] {
+        if d == 0.0 {
+            if fabs(o - c) >= h {
+                return None;
+            }
+        } else {
+            let t1 = (c - h - o) / d;
+            let t2 = (c + h - o) / d;
+            enter = enter.max(t1.min(t2));
+            exit = exit.min(t1.max(t2));
+        }
+    }
+
+    if enter < exit {
+        Some((enter, exit))
+    } else {
+        None
+    }
+}
+
+/// Entry and exit times of the ray `o + t * d` (with `d` of unit length) through the
+/// open circle of `radius` around `(cx, cy)`, or `None` if the ray misses it.
+fn ray_circle(ox: f64, oy: f64, dx: f64, dy: f64, cx: f64, cy: f64, radius: f64) -> Option<(f64, f64)> {
+    let b = (ox - cx) * dx + (oy - cy) * dy;
+    let c = pow(ox - cx, 2.0) + pow(oy - cy, 2.0) - radius * radius;
+    let discriminant = b * b - c;
+
+    if discriminant <= 0.0 {
+        return None;
+    }
+
+    let root = sqrt(discriminant);
+    Some((-b - root, -b + root))
+}
+
+/// First time at or after 0 that the ray is inside the union of the `spans`.
+fn first_entry(spans: &[Option<(f64, f64)>]) -> Option<f64> {
+    spans
+        .iter()
+        .flatten()
+        .filter(|(_, exit)| *exit > 0.0)
+        .map(|(enter, _)| enter.max(0.0))
+        .reduce(f64::min)
+}
+
+/// Direction, time of the first grid line crossing and time between crossings of a
+/// ray starting at `o` with velocity `d` along one axis.
+fn axis_steps(o: f64, d: f64) -> (isize, f64, f64) {
+    if d > 0.0 {
+        (1, (floor(o) + 1.0 - o) / d, 1.0 / d)
+    } else if d < 0.0 {
+        (-1, (o - floor(o)) / -d, 1.0 / -d)
+    } else {
+        (0, f64::INFINITY, f64::INFINITY)
+    }
+}
+
+/// A ray direction for the DDA engine. sin and cos of right angles are a rounding error
+/// away from 0, which would make rays along a grid line drift to one side of it.
+fn dda_direction(forward: (f64, f64)) -> (f64, f64) {
+    let (mut dx, mut dy) = forward;
+    if fabs(dx) < 1e-12 {
+        dx = 0.0;
+    }
+    if fabs(dy) < 1e-12 {
+        dy = 0.0;
+    }
+    (dx, dy)
+}
+
+/// The team of each seat when teams of `team_sizes` players take turns in rotation,
+/// skipping teams with nobody left.
+fn seat_teams(team_sizes: &[usize]) -> Vec<usize> {
+    let mut left = team_sizes.to_vec();
+    let mut teams = Vec::with_capacity(left.iter().sum());
+    while left.iter().any(|&size| size > 0) {
+        for (team, size) in left.iter_mut().enumerate() {
+            if *size > 0 {
+                teams.push(team);
+                *size -= 1;
+            }
+        }
+    }
+    teams
+}
+
+/// The walls of a map, as seen by the unit box a ray sweeps through it.
+///
+/// A unit box at `(x, y)` collides with the wall of cell `(cx, cy)` when
+/// `|x - cx| < 1` and `|y - cy| < 1`, so the places such a box cannot be are the unit
+/// squares `[i, i + 1] x [j, j + 1]` with a wall on one of their four corners. Those
+/// squares form a regular grid, which a ray can walk square by square.
+#[derive(Clone)]
+struct WallZones {
+    width: usize,
+    height: usize,
+    walls: Vec<bool>,
+    blocked: Vec<bool>,
+    clearance: Vec<f64>,
+}
+
+impl WallZones {
+    fn new(walls: &[Vec<u8>]) -> Self {
+        let height = walls.len();
+        let width = walls.iter().map(|row| row.len()).max().unwrap_or(0);
+
+        let mut zones = Self {
+            width,
+            height,
+            walls: vec![false; width * height],
+            blocked: vec![false; (width + 1) * (height + 1)],
+            clearance: vec![f64::INFINITY; (width + 1) * (height + 1)],
+        };
+
+        for (y, row) in walls.iter().enumerate() {
+            for (x, cell) in row.iter().enumerate() {
+                zones.walls[y * width + x] = *cell == 1;
+            }
+        }
+
+        // Squares start at corner -1, so square (i, j) is stored at (i + 1, j + 1).
+        for j in -1..height as isize {
+            for i in -1..width as isize {
+                zones.blocked[(j + 1) as usize * (width + 1) + (i + 1) as usize] = zones.wall(i, j)
+                    || zones.wall(i + 1, j)
+                    || zones.wall(i, j + 1)
+                    || zones.wall(i + 1, j + 1);
+            }
+        }
+
+        // Clearance: a breadth-first search out of the blocked squares gives the number
+        // of king moves `d` to the nearest one, and no point of a square `d` moves away
+        // is closer to it than `d - 1`.
+        let (columns, rows) = (width as isize + 1, height as isize + 1);
+        let mut moves = vec![usize::MAX; zones.blocked.len()];
+        let mut queue: VecDeque<usize> = (0..zones.blocked.len()).filter(|&k| zones.blocked[k]).collect();
+        for &k in queue.iter() {
+            moves[k] = 0;
+        }
+        while let Some(k) = queue.pop_front() {
+            let (i, j) = (k as isize % columns, k as isize / columns);
+            for (di, dj) in [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)] {
+                let (ni, nj) = (i + di, j + dj);
+                if ni >= 0 && nj >= 0 && ni < columns && nj < rows {
+                    let next = (nj * columns + ni) as usize;
+                    if moves[next] == usize::MAX {
+                        moves[next] = moves[k] + 1;
+                        queue.push_back(next);
+                    }
+                }
+            }
+        }
+        for (clearance, moves) in zones.clearance.iter_mut().zip(moves) {
+            if moves != usize::MAX {
+                *clearance = moves.saturating_sub(1) as f64;
+            }
+        }
+
+        zones
+    }
+
+    /// How far any point of the square holding `(x, y)` is from the nearest blocked
+    /// square, at least. 0 outside the map, where nothing is known.
+    fn clearance(&self, x: f64, y: f64) -> f64 {
+        let (i, j) = (floor(x), floor(y));
+        if !(i >= -1.0 && j >= -1.0 && i < self.width as f64 && j < self.height as f64) {
+            return 0.0;
+        }
+        self.clearance[(j as usize + 1) * (self.width + 1) + (i as usize + 1)]
+    }
+
+    fn wall(&self, x: isize, y: isize) -> bool {
+        x >= 0
+            && y >= 0
+            && (x as usize) < self.width
+            && (y as usize) < self.height
+            && self.walls[y as usize * self.width + x as usize]
+    }
+
+    fn blocked(&self, i: isize, j: isize) -> bool {
+        i >= -1
+            && j >= -1
+            && i < self.width as isize
+            && j < self.height as isize
+            && self.blocked[(j + 1) as usize * (self.width + 1) + (i + 1) as usize]
+    }
+
+    /// Distance along the unit direction `d` from `o` to the first wall, walking the
+    /// squares the ray crosses (DDA). Gives up with `None` past `limit`.
+    fn cast(&self, ox: f64, oy: f64, dx: f64, dy: f64, limit: f64) -> Option<f64> {
+        // A ray running exactly along a grid line only touches the walls on that line,
+        // not all the walls of the squares on either side of it.
+        let on_column = dx == 0.0 && ox == floor(ox);
+        let on_row = dy == 0.0 && oy == floor(oy);
+        let blocked = |i: isize, j: isize| {
+            if on_column {
+                self.wall(i, j) || self.wall(i, j + 1)
+            } else if on_row {
+                self.wall(i, j) || self.wall(i + 1, j)
+            } else {
+                self.blocked(i, j)
+            }
+        };
+
+        let mut i = floor(ox) as isize;
+        let mut j = floor(oy) as isize;
+        let (step_i, mut next_x, delta_x) = axis_steps(ox, dx);
+        let (step_j, mut next_y, delta_y) = axis_steps(oy, dy);
+        let mut t = 0.0;
+
+        loop {
+            let leave = next_x.min(next_y);
+            if leave > t && blocked(i, j) {
+                return Some(t);
+            }
+            if leave > limit {
+                return None;
+            }
+
+            // Crossing a corner exactly moves diagonally, as the ray only touches the
+            // squares beside it.
+            let cross_x = next_x <= next_y;
+            let cross_y = next_y <= next_x;
+
+            // Past the outermost squares with a wall corner there is nothing to hit.
+            if (cross_x && ((step_i < 0 && i <= -1) || (step_i > 0 && i >= self.width as isize)))
+                || (cross_y && ((step_j < 0 && j <= -1) || (step_j > 0 && j >= self.height as isize)))
+            {
+                return None;
+            }
+
+            if cross_x {
+                i += step_i;
+                next_x += delta_x;
+            }
+            if cross_y {
+                j += step_j;
+                next_y += delta_y;
+            }
+            t = leave;
+        }
+    }
+}
+
+/// Everything derived from a map's walls. It is built once per map and shared by every
+/// Utils on that map (see `MapIndex::of`), so new matches and resets reuse it as is.
+struct MapIndex {
+    walls: Vec<Vec<u8>>,
+    zones: WallZones,
+    // Per cell, a bitset of the cells it has a line of sight to, filled in on first use.
+    visible: Vec<OnceLock<Vec<u64>>>,
+}
+
+static MAP_INDEXES: Mutex<Vec<Weak<MapIndex>>> = Mutex::new(Vec::new());
+
+impl MapIndex {
+    fn new(walls: Vec<Vec<u8>>) -> Self {
+        let zones = WallZones::new(&walls);
+        let cells = zones.width * zones.height;
+        Self {
+            visible: (0..cells).map(|_| OnceLock::new()).collect(),
+            walls,
+            zones,
+        }
+    }
+
+    /// The index of `walls`, shared with every live Utils on the same map.
+    fn of(walls: Vec<Vec<u8>>) -> Arc<Self> {
+        let mut indexes = MAP_INDEXES.lock().unwrap_or_else(|poisoned| poisoned.into_inner());
+        indexes.retain(|index| index.strong_count() > 0);
+        if let Some(index) = indexes.iter().filter_map(Weak::upgrade).find(|index| index.walls == walls) {
+            return index;
+        }
+
+        let index = Arc::new(Self::new(walls));
+        indexes.push(Arc::downgrade(&index));
+        index
+    }
+
+    /// The cell nearest `(x, y)`, if it is on the map and not a wall.
+    fn cell(&self, x: f64, y: f64) -> Option<usize> {
+        let (cx, cy) = (round(x), round(y));
+        if !(cx >= 0.0 && cy >= 0.0) {
+            return None;
+        }
+        let (cx, cy) = (cx as isize, cy as isize);
+        if (cx as usize) < self.zones.width && (cy as usize) < self.zones.height && !self.zones.wall(cx, cy) {
+            Some(cy as usize * self.zones.width + cx as usize)
+        } else {
+            None
+        }
+    }
+
+    /// The cells a unit box centered on `cell` can see the centers of without a wall in
+    /// the way, as a bitset over `y * width + x`.
+    fn visible_from(&self, cell: usize) -> &[u64] {
+        self.visible[cell].get_or_init(|| {
+            let width = self.zones.width;
+            let (x, y) = ((cell % width) as f64, (cell / width) as f64);
+            let mut seen = vec![0u64; (self.visible.len() + 63) / 64];
+            for other in 0..self.visible.len() {
+                let (x2, y2) = ((other % width) as f64, (other / width) as f64);
+                if self.zones.wall(x2 as isize, y2 as isize) {
+                    continue;
+                }
+
+                let distance = sqrt(pow(x2 - x, 2.0) + pow(y2 - y, 2.0));
+                let clear = distance == 0.0
+                    || self
+                        .zones
+                        .cast(x, y, (x2 - x) / distance, (y2 - y) / distance, distance)
+                        .map_or(true, |t| t >= distance);
+                if clear {
+                    seen[other / 64] |= 1 << (other % 64);
+                }
+            }
+            seen
+        })
+    }
+}
+
+#[derive(Clone, Copy, PartialEq)]
+enum RayEngine {
+    March,
+    Dda,
+}
+
+/// A fan of `rays` rays spread over `fov` degrees around the player's rotation, with the
+/// angle of each ray relative to the rotation computed once for all casts.
+struct RayFan {
+    fov: f64,
+    rays: f64,
+    offsets: Vec<f64>,
+}
+
+impl RayFan {
+    fn new(fov: f64, rays: f64) -> Self {
+        // The offsets are summed step by step as `ray_fov` always did, so every ray keeps
+        // the exact angle, and the observations of trained policies stay the same.
+        let per = fov / rays;
+        let offsets = (0..ceil(rays).max(0.0) as usize)
+            .scan(-fov / 2.0, |offset, _| {
+                let current = *offset;
+                *offset += per;
+                Some(current)
+            })
+            .collect();
+
+        Self { fov, rays, offsets }
+    }
+
+    fn is(&self, fov: f64, rays: f64) -> bool {
+        self.fov == fov && self.rays == rays
+    }
+
+    /// Unit directions of the rays for a player facing `rotation` degrees, as the
+    /// `forward` of each ray's angle. Rotating cached directions instead would round
+    /// differently in the last bit, which is enough to move some hits.
+    fn directions(&self, rotation: f64) -> impl Iterator<Item = (f64, f64)> + '_ {
+        self.offsets.iter().map(move |&offset| {
+            let angle = (rotation + offset).to_radians();
+            (sin(angle), cos(angle))
+        })
+    }
+}
+
+/// Where a ray first meets a wall: the distance, or None when it leaves an open map, and
+/// for the march engine the step it got there on.
+#[derive(Clone, Copy)]
+struct WallHit {
+    distance: Option<f64>,
+    steps: usize,
+}
+
+/// The wall hits of a fan cast from `pose` (x, y, rotation). Walls never change during
+/// a match, so they hold for as long as the player keeps that exact pose and the fan
+/// and engine stay the same; only players, smokes and flashbangs are traced again.
+struct WallLayer {
+    pose: (f64, f64, f64),
+    fov: f64,
+    rays: f64,
+    engine: RayEngine,
+    hits: Vec<WallHit>,
+}
+
+impl WallLayer {
+    fn is(&self, pose: (f64, f64, f64), fan: &RayFan, engine: RayEngine) -> bool {
+        self.pose == pose && fan.is(self.fov, self.rays) && self.engine == engine
+    }
+}
+
+/// A player, opened smoke or opened flashbang, by index. They order like the scans they
+/// replace: players, then smokes, then flashbangs, each by index.
+#[derive(Clone, Copy, PartialEq, Eq, PartialOrd, Ord)]
+enum Entity {
+    Player(usize),
+    Smoke(usize),
+    Flash(usize),
+}
+
+// A ray tests a smoke or flashbang at about the cost of this many players, and a fan of
+// rays uses a grid once its tests add up to this many players. Grids of more cells than
+// this are not built.
+const GRID_UTILITY_COST: usize = 4;
+const GRID_MIN_COST: usize = 6;
+const GRID_MAX_CELLS: f64 = 65536.0;
+// Bullet hit checks use one once there are this many player and bullet pairs.
+const GRID_MIN_PAIRS: usize = 64;
+// Regions are listed a little beyond their edges, so that rounding in the cell walk of
+// a ray cannot skip past an entity it grazes.
+const GRID_SLACK: f64 = 1e-9;
+
+/// Spatial hash of the players, opened smokes and opened flashbangs on unit cells.
+///
+/// A unit box at `(x, y)` collides with one of them exactly when `(x, y)` is inside the
+/// entity's region: its box, or the smoke's circle, grown by the unit box. Every entity
+/// is listed in each cell its region overlaps, so a unit box only needs testing against
+/// the entities listed in its own cell and a ray against those in the cells it crosses.
+/// It is built for a batch of queries on an unchanging world, such as a fan of rays or
+/// a hit check, so it never goes stale.
+struct EntityGrid {
+    x0: f64,
+    y0: f64,
+    columns: usize,
+    rows: usize,
+    // The entities of cell `c` are `entities[starts[c]..starts[c + 1]]`, in order.
+    starts: Vec<usize>,
+    entities: Vec<Entity>,
+}
+
+impl EntityGrid {
+    /// The grid of the players of `utils`, and with `utilities` its opened smokes and
+    /// flashbangs too. None when positions are not finite or too spread out for a grid.
+    fn new(utils: &Utils, utilities: bool) -> Option<Self> {
+        let (hx, hy) = utils.player_reach();
+        let r = utils.smokes_radius;
+        let mut regions: Vec<(Entity, [f64; 4])> = Vec::new();
+        for (i, player) in utils.players.iter().enumerate() {
+            regions.push((Entity::Player(i), [player.x - hx, player.y - hy, player.x + hx, player.y + hy]));
+        }
+        if utilities {
+            for (i, smoke) in utils.smokes.iter().enumerate().filter(|(_, smoke)| smoke.opened) {
+                regions.push((Entity::Smoke(i), [smoke.x - 1.0 - r, smoke.y - 1.0 - r, smoke.x + r, smoke.y + r]));
+            }
+            for (i, flash) in utils.flashes.iter().enumerate().filter(|(_, flash)| flash.opened) {
+                regions.push((Entity::Flash(i), [flash.x - 1.0, flash.y - 1.0, flash.x + 1.0, flash.y + 1.0]));
+            }
+        }
+
+        let mut bounds = [f64::INFINITY, f64::INFINITY, f64::NEG_INFINITY, f64::NEG_INFINITY];
+        for (_, region) in regions.iter_mut() {
+            if !region.iter().all(|v| v.is_finite()) {
+                return None;
+            }
+            region[0] -= GRID_SLACK;
+            region[1] -= GRID_SLACK;
+            region[2] += GRID_SLACK;
+            region[3] += GRID_SLACK;
+            bounds = [bounds[0].min(region[0]), bounds[1].min(region[1]), bounds[2].max(region[2]), bounds[3].max(region[3])];
+        }
+        let (x0, y0) = (floor(bounds[0]), floor(bounds[1]));
+        let (columns, rows) = (floor(bounds[2]) - x0 + 1.0, floor(bounds[3]) - y0 + 1.0);
+        if !(columns * rows <= GRID_MAX_CELLS) {
+            return None;
+        }
+
+        let mut grid = Self {
+            x0,
+            y0,
+            columns: columns as usize,
+            rows: rows as usize,
+            starts: vec![0; columns as usize * rows as usize + 1],
+            entities: Vec::new(),
+        };
+        let cells = |region: &[f64; 4]| {
+            let (i0, j0) = ((floor(region[0]) - x0) as usize, (floor(region[1]) - y0) as usize);
+            let (i1, j1) = ((floor(region[2]) - x0) as usize, (floor(region[3]) - y0) as usize);
+            (j0..=j1).flat_map(move |j| (i0..=i1).map(move |i| j * columns as usize + i))
+        };
+
+        // Counting sort: count each cell's entities, then fill the cells in entity order.
+        for (_, region) in &regions {
+            for cell in cells(region) {
+                grid.starts[cell + 1] += 1;
+            }
+        }
+        for cell in 1..grid.starts.len() {
+            grid.starts[cell] += grid.starts[cell - 1];
+        }
+        let mut next = grid.starts.clone();
+        grid.entities = vec![Entity::Player(0); grid.starts[grid.starts.len() - 1]];
+        for (entity, region) in &regions {
+            for cell in cells(region) {
+                grid.entities[next[cell]] = *entity;
+                next[cell] += 1;
+            }
+        }
+        Some(grid)
+    }
+
+    fn cell_at(&self, i: isize, j: isize) -> Option<&[Entity]> {
+        if i < 0 || j < 0 || i as usize >= self.columns || j as usize >= self.rows {
+            return None;
+        }
+        let cell = j as usize * self.columns + i as usize;
+        Some(&self.entities[self.starts[cell]..self.starts[cell + 1]])
+    }
+
+    /// The entities whose regions may contain `(x, y)`.
+    fn at(&self, x: f64, y: f64) -> &[Entity] {
+        self.cell_at((floor(x) - self.x0) as isize, (floor(y) - self.y0) as isize).unwrap_or(&[])
+    }
+
+    /// Calls `visit` with the entities of each cell the ray `o + t * d` crosses, in the
+    /// order it crosses them, until it leaves the grid or passes `limit`. `visit` returns
+    /// how far the ray still needs to look.
+    fn walk(&self, ox: f64, oy: f64, dx: f64, dy: f64, mut limit: f64, mut visit: impl FnMut(&[Entity]) -> f64) {
+        let mut i = (floor(ox) - self.x0) as isize;
+        let mut j = (floor(oy) - self.y0) as isize;
+        let (step_i, mut next_x, delta_x) = axis_steps(ox, dx);
+        let (step_j, mut next_y, delta_y) = axis_steps(oy, dy);
+
+        let Some(mut entities) = self.cell_at(i, j) else {
+            // Rays from outside the grid are not walked: they look at everything.
+            visit(&self.entities);
+            return;
+        };
+        loop {
+            limit = limit.min(visit(entities));
+            let leave = next_x.min(next_y);
+            if leave == f64::INFINITY || leave > limit + GRID_SLACK {
+                return;
+            }
+            if next_x <= next_y {
+                i += step_i;
+                next_x += delta_x;
+            } else {
+                j += step_j;
+                next_y += delta_y;
+            }
+            match self.cell_at(i, j) {
+                Some(cell) => entities = cell,
+                None => return,
+            }
+        }
+    }
+}
 
 #[pyclass]
 struct LoggingStdout;
@@ -12,7 +637,7 @@ impl LoggingStdout {
 }
 
 #[pyclass]
-#[derive(Clone)]
+#[derive(Clone, Copy)]
 struct Bullet {
     #[pyo3(get)]
     pub x: f64,
@@ -24,7 +649,6 @@ struct Bullet {
 }
 
 #[pyclass]
-#[derive(Clone)]
 struct Player {
     #[pyo3(get)]
     pub x: f64,
@@ -47,11 +671,13 @@ struct Player {
     #[pyo3(get)]
     pub flashed_for: u8,
     #[pyo3(get)]
-    pub flashes: u8
+    pub flashes: u8,
+    #[pyo3(get)]
+    pub team: usize,
 }
 
 #[pyclass]
-#[derive(Clone)]
+#[derive(Clone, Copy)]
 struct Smoke {
     #[pyo3(get)]
     pub x: f64,
@@ -67,7 +693,7 @@ struct Smoke {
 }
 
 #[pyclass]
-#[derive(Clone)]
+#[derive(Clone, Copy)]
 struct Flashbang {
     #[pyo3(get)]
     pub x: f64,
@@ -80,10 +706,82 @@ struct Flashbang {
     pub frames_opened: u8,
 }
 
+// Everything but the memory is plain data. `clone_from` copies it over and reuses the
+// memory vectors, so restoring a snapshot into a world does not allocate.
+impl Clone for Player {
+    fn clone(&self) -> Self {
+        Self {
+            memory_values: self.memory_values.clone(),
+            memory_keys: self.memory_keys.clone(),
+            ..*self
+        }
+    }
+
+    fn clone_from(&mut self, source: &Self) {
+        let mut memory_values = std::mem::take(&mut self.memory_values);
+        let mut memory_keys = std::mem::take(&mut self.memory_keys);
+        memory_values.clone_from(&source.memory_values);
+        memory_keys.clone_from(&source.memory_keys);
+        *self = Self {
+            memory_values,
+            memory_keys,
+            ..*source
+        };
+    }
+}
+
+/// The part of a match that changes as it is played, saved by `Utils.snapshot`. The
+/// map, settings and caches stay with the world.
 #[pyclass]
-struct Utils {
+#[derive(Clone)]
+struct Snapshot {
+    map: Arc<MapIndex>,
+    players: Vec<Player>,
+    bullets: Vec<Bullet>,
+    smokes: Vec<Smoke>,
+    flashes: Vec<Flashbang>,
     #[pyo3(get)]
-    pub walls: Vec<Vec<u8>>,
+    turn: usize,
+}
+
+// Packed rows exported by `Utils.*_into`, in the field order of env.py's dtypes.
+
+impl Player {
+    fn row(&self) -> [f64; 8] {
+        [
+            self.x,
+            self.y,
+            self.rotation,
+            self.ammo as f64,
+            self.sound,
+            self.smokes as f64,
+            self.flashes as f64,
+            self.flashed as u8 as f64,
+        ]
+    }
+}
+
+impl Bullet {
+    fn row(&self) -> [f64; 4] {
+        [self.x, self.y, self.rotation, self.fired_by as f64]
+    }
+}
+
+impl Smoke {
+    fn row(&self) -> [f64; 4] {
+        [self.x, self.y, self.radius, self.opened as u8 as f64]
+    }
+}
+
+impl Flashbang {
+    fn row(&self) -> [f64; 3] {
+        [self.x, self.y, self.opened as u8 as f64]
+    }
+}
+
+#[pyclass]
+#[derive(Clone)]
+struct Utils {
     #[pyo3(get)]
     pub wall_width: u8,
     #[pyo3(get)]
@@ -98,6 +796,8 @@ struct Utils {
     pub ammo_total: u8,
     #[pyo3(get)]
     pub players: Vec<Player>,
+    // The players as every match starts.
+    start: Vec<Player>,
     #[pyo3(get)]
     pub turn: usize,
     #[pyo3(get)]
@@ -112,61 +812,88 @@ struct Utils {
     pub flash_max_open: u8,
     pub flash_blind: u8,
     pub flash_max_distance: f64,
+    #[pyo3(get, set)]
+    pub parallel_rays: bool,
+    #[pyo3(get, set)]
+    pub wall_cache: bool,
+    map: Arc<MapIndex>,
+    ray_engine: RayEngine,
+    // The fan observations are made with, and the last other fan `ray_fov` cast.
+    view: Arc<RayFan>,
+    fan: Arc<RayFan>,
+    // The wall hits of the last fan each player cast.
+    wall_layers: Vec<Option<Arc<WallLayer>>>,
 }
 
 #[pymethods]
 impl Utils {
+    /// A match on `walls` between teams of `team_sizes` players, one each by default.
+    /// Seats go round the teams, so teammates take their turns between opponents'.
+    /// `spawns` gives each player's `(x, y, rotation)`; without it the first two teams
+    /// start at the default spawns, their other members on the nearest free cells.
     #[new]
-    fn new(walls: Vec<Vec<u8>>) -> Self {
-        Self {
-            walls,
-            wall_width: 1,
-            wall_height: 1,
-            bullets: Vec::new(),
-            player_width: 1,
-            player_height: 1,
-            ammo_total: 30,
-            players: vec![
-                Player {
-                    x: 9.0,
-                    y: 11.0,
-                    rotation: 270.0,
-                    ammo: 30,
-                    sound: 0.0,
-                    memory_values: Vec::new(),
-                    memory_keys: Vec::new(),
-                    smokes: 3,
-                    flashed: false,
-                    flashed_for: 0,
-                    flashes: 2,
-                },
-                Player {
-                    x: 1.0,
-                    y: 1.0,
-                    rotation: 90.0,
-                    ammo: 30,
-                    sound: 0.0,
-                    memory_values: Vec::new(),
-                    memory_keys: Vec::new(),
-                    smokes: 3,
-                    flashed: false,
-                    flashed_for: 0,
-                    flashes: 2
-                },
-            ],
-            turn: 0,
-            smokes: vec![],
-            flashes: vec![],
-            smokes_radius: 2.0,
-            smokes_max_move: 5,
-            smokes_max_open: 180,
-            flash_blind: 15,
-            flash_max_move: 5,
-            flash_max_open: 5,
-            flash_max_distance: 7.0,
+    fn py_new(walls: Vec<Vec<u8>>, team_sizes: Option<Vec<usize>>, spawns: Option<Vec<(f64, f64, f64)>>) -> PyResult<Self> {
+        Self::with_teams(walls, &team_sizes.unwrap_or_else(|| vec![1, 1]), spawns)
+    }
+
+    /// Starts a new match on the same map: the players back at their spawns with full
+    /// ammo and utilities, no bullets, smokes or flashbangs, and player 0 to move.
+    /// `spawns` gives each player's `(x, y)` instead of the configured spawns. Settings
+    /// such as the ray engine and view are kept, and the map index is reused.
+    fn reset(&mut self, spawns: Option<Vec<(f64, f64)>>) -> PyResult<()> {
+        if let Some(spawns) = &spawns {
+            if spawns.len() != self.start.len() {
+                return Err(PyValueError::new_err(format!(
+                    "expected {} spawns, got {}",
+                    self.start.len(),
+                    spawns.len()
+                )));
+            }
+            for &(x, y) in spawns {
+                self.check_spawn(x, y)?;
+            }
+        }
+
+        self.players.clone_from(&self.start);
+        for (player, (x, y)) in self.players.iter_mut().zip(spawns.into_iter().flatten()) {
+            player.x = x;
+            player.y = y;
+        }
+        self.bullets.clear();
+        self.smokes.clear();
+        self.flashes.clear();
+        self.turn = 0;
+        Ok(())
+    }
+
+    /// Saves the state of the match: players, bullets, smokes, flashbangs and whose turn
+    /// it is. `restore` returns this or any other world on the same map to it.
+    fn snapshot(&self) -> Snapshot {
+        Snapshot {
+            map: self.map.clone(),
+            players: self.players.clone(),
+            bullets: self.bullets.clone(),
+            smokes: self.smokes.clone(),
+            flashes: self.flashes.clone(),
+            turn: self.turn,
         }
     }
 
+    /// Like `snapshot`, but saves into an existing snapshot and reuses its memory.
+    fn snapshot_into(&self, mut snapshot: PyRefMut<Snapshot>) {
+        self.save_into(&mut snapshot);
+    }
+
+    fn restore(&mut self, snapshot: PyRef<Snapshot>) -> PyResult<()> {
+        self.restore_from(&snapshot)
+    }
+
+    /// An independent copy of this world, settings and caches included. Only the map
+    /// index is shared.
+    fn fork(&self) -> Utils {
+        self.clone()
+    }
+
     fn colliding(
         &self,
         x: f64,
@@ -217,9 +944,21 @@ impl Utils {
     }
 
     fn is_colliding_with_wall(&self, x: f64, y: f64, width: u8, height: u8) -> (bool, f64, f64) {
-        for y2 in 0..self.walls.len() {
-            for x2 in 0..self.walls[y2].len() {
-                if self.walls[y2][x2] == 1 {
+        // A unit box only collides inside a blocked square of the map index.
+        if width == 1 && height == 1 && self.wall_width == 1 && self.wall_height == 1 {
+            if !self.map.zones.blocked(floor(x) as isize, floor(y) as isize) {
+                return (false, 0.0, 0.0);
+            }
+        }
+
+        // Only the cells whose centers are within reach of the box can collide with it,
+        // and scanning them in row-major order keeps the first hit the same as a full scan.
+        let reach_x = (width as f64 + self.wall_width as f64) / 2.0;
+        let reach_y = (height as f64 + self.wall_height as f64) / 2.0;
+
+        for y2 in wall_cells(y - reach_y, y + reach_y, self.wall_height, self.map.walls.len()) {
+            for x2 in wall_cells(x - reach_x, x + reach_x, self.wall_width, self.map.walls[y2].len()) {
+                if self.map.walls[y2][x2] == 1 {
                     let collide = self.colliding(
                         x,
                         y,
@@ -311,9 +1050,13 @@ impl Utils {
     }
 
     fn is_smoke_colliding_with_wall(&self, x: f64, y: f64, radius: f64) -> bool {
-        for y2 in 0..self.walls.len() {
-            for x2 in 0..self.walls[y2].len() {
-                if self.walls[y2][x2] == 1 {
+        let ys = wall_cells(y - radius - self.wall_height as f64, y + radius, 1, self.map.walls.len());
+
+        for y2 in ys {
+            let xs = wall_cells(x - radius - self.wall_width as f64, x + radius, 1, self.map.walls[y2].len());
+
+            for x2 in xs {
+                if self.map.walls[y2][x2] == 1 {
                     let collide = self.colliding_circle(x2 as f64, y2 as f64, self.wall_width, self.wall_height, x, y, radius);
 
                     if collide {
@@ -344,29 +1087,20 @@ impl Utils {
         self.players[self.turn].x += controller_x.min(1.0).max(-1.0);
         self.players[self.turn].y += controller_y.min(1.0).max(-1.0);
 
-        for (i, player) in self.players.iter().enumerate() {
-            if i != self.turn {
-                if self
-                    .is_colliding_with_wall(
-                        self.players[self.turn].x,
-                        self.players[self.turn].y,
-                        self.player_width,
-                        self.player_height,
-                    )
-                    .0
-                    || self.is_colliding_with_player(
-                        player.clone(),
-                        self.players[self.turn].x,
-                        self.players[self.turn].y,
-                        self.player_width,
-                        self.player_height,
-                    )
-                {
-                    self.players[self.turn].x -= controller_x.min(1.0).max(-1.0);
-                    self.players[self.turn].y -= controller_y.min(1.0).max(-1.0);
-                    break;
-                }
-            }
+        // The move is undone when the player ends up in a wall or another player. The
+        // wall check does not depend on the other players, so it is only done once.
+        let (x, y) = (self.players[self.turn].x, self.players[self.turn].y);
+        let (width, height) = (self.player_width, self.player_height);
+        let blocked = self.is_colliding_with_wall(x, y, width, height).0
+            || self
+                .players
+                .iter()
+                .enumerate()
+                .any(|(i, player)| i != self.turn && self.colliding(x, y, width, height, player.x, player.y, width, height));
+
+        if blocked {
+            self.players[self.turn].x -= controller_x.min(1.0).max(-1.0);
+            self.players[self.turn].y -= controller_y.min(1.0).max(-1.0);
         }
     }
 
@@ -386,190 +1120,970 @@ impl Utils {
         }
     }
 
-    fn bullet_tick(&mut self) {
-        let mut bullets: Vec<Bullet> = vec![];
+    fn bullet_tick(&mut self, py: Python) {
+        py.allow_threads(|| self.tick_bullets())
+    }
 
-        for i in 0..self.bullets.len() {
-            let forward = self.forward(self.bullets[i].rotation);
+    fn get_players_hit_by_bullet(&mut self) -> Vec<usize> {
+        self.players_hit(self.bullet_grid().as_ref())
+    }
 
-            self.bullets[i].x += forward.0;
-            self.bullets[i].y += forward.1;
+    /// Shaping reward for the player whose turn it is and the players hit by a bullet,
+    /// as `(reward, hits)`; the natively computed pair ShooterEnv scores a move with.
+    fn step_reward(&self) -> (f64, Vec<usize>) {
+        let grid = self.bullet_grid();
+        (self.shaping_reward(grid.as_ref()), self.players_hit(grid.as_ref()))
+    }
 
-            bullets.push(self.bullets[i].clone());
+    /// Plays `rounds` more rounds of every seat, each player repeating its row of the
+    /// float32 `(num_players, 12)` buffer `actions`: the repeated frames of a ShooterEnv
+    /// step with frame skip, for the learner in seat `learner`. Returns the learner's
+    /// summed reward and whether the match ended, which stops the rounds there.
+    fn repeat_actions(&mut self, py: Python, actions: &PyAny, learner: usize, rounds: usize) -> PyResult<(f64, bool)> {
+        let learner = self.player_index(Some(learner))?;
+        let actions = PyBuffer::<f32>::get(actions)?;
+        let actions = buffer_as_slice(&actions, self.players.len() * ACTION_SIZE)?;
+        Ok(py.allow_threads(|| self.play_rounds(actions, learner, rounds)))
+    }
 
-            if self
-                .is_colliding_with_wall(self.bullets[i].x, self.bullets[i].y, 1, 1)
-                .0
-            {
-                bullets.pop();
-            }
+    fn next_turn(&mut self) {
+        self.turn = (self.turn + 1) % self.players.len();
+    }
+
+    fn distance(&self, x: f64, y: f64, x2: f64, y2: f64) -> f64 {
+        sqrt(pow(x - x2, 2.0) + pow(y - y2, 2.0))
+    }
+
+    #[getter]
+    fn walls(&self) -> Vec<Vec<u8>> {
+        self.map.walls.clone()
+    }
+
+    /// Whether a player on the cell nearest `(x, y)` has a line of sight, clear of
+    /// walls, to the cell nearest `(x2, y2)`. Cells off the map or in a wall see nothing.
+    fn cell_visible(&self, x: f64, y: f64, x2: f64, y2: f64) -> bool {
+        match (self.map.cell(x, y), self.map.cell(x2, y2)) {
+            (Some(from), Some(to)) => self.map.visible_from(from)[to / 64] & (1 << (to % 64)) != 0,
+            _ => false,
         }
+    }
 
-        self.bullets = bullets;
+    /// The `(x, y)` cells a player on the cell nearest `(x, y)` has a line of sight to.
+    fn visible_cells(&self, x: f64, y: f64) -> Vec<(usize, usize)> {
+        let Some(from) = self.map.cell(x, y) else {
+            return Vec::new();
+        };
+        let width = self.map.zones.width;
+        let seen = self.map.visible_from(from);
+        (0..width * self.map.zones.height)
+            .filter(|&to| seen[to / 64] & (1 << (to % 64)) != 0)
+            .map(|to| (to % width, to / width))
+            .collect()
     }
 
-    fn get_players_hit_by_bullet(&mut self) -> Vec<usize> {
-        let mut players_hit = vec![];
-
-        for i in 0..self.players.len() {
-            for j in 0..self.bullets.len() {
-                if self.bullets[j].fired_by != i {
-                    if self.is_colliding_with_player(
-                        self.players[i].clone(),
-                        self.bullets[j].x,
-                        self.bullets[j].y,
-                        1,
-                        1,
-                    ) {
-                        players_hit.push(i);
-                    }
+    /// How rays are cast: "march" (the default) steps them a unit at a time, and "dda"
+    /// walks the grid and stops at the exact touch. DDA wall distances are about 1 unit
+    /// shorter, so observations differ between the two and a policy trained with one
+    /// engine does not carry over to the other.
+    #[getter]
+    fn ray_engine(&self) -> &'static str {
+        match self.ray_engine {
+            RayEngine::March => "march",
+            RayEngine::Dda => "dda",
+        }
+    }
+
+    #[setter]
+    fn set_ray_engine(&mut self, engine: &str) -> PyResult<()> {
+        self.ray_engine = match engine {
+            "march" => RayEngine::March,
+            "dda" => RayEngine::Dda,
+            _ => {
+                return Err(PyValueError::new_err(format!(
+                    "unknown ray engine {:?}, expected \"march\" or \"dda\"",
+                    engine
+                )))
+            }
+        };
+        Ok(())
+    }
+
+    fn ray(&mut self, x: f64, y: f64, rotation: f64) -> (f64, u8) {
+        let hit = self.trace(x, y, rotation);
+        self.flash_if(hit.2);
+        (hit.0, hit.1)
+    }
+
+    fn ray_march(&mut self, x: f64, y: f64, rotation: f64) -> (f64, u8) {
+        let hit = self.trace_march(x, y, self.forward(rotation), None, None);
+        self.flash_if(hit.2);
+        (hit.0, hit.1)
+    }
+
+    fn ray_dda(&mut self, x: f64, y: f64, rotation: f64) -> (f64, u8) {
+        let hit = self.trace_dda(x, y, self.forward(rotation), None, None);
+        self.flash_if(hit.2);
+        (hit.0, hit.1)
+    }
+
+    fn ray_fov(&mut self, py: Python, fov: f64, number_of_rays: f64) -> Vec<(f64, u8)> {
+        py.allow_threads(|| self.cast_fov(fov, number_of_rays))
+    }
+
+    /// Makes observations cast `rays` rays over `fov` degrees; `obs_size` follows.
+    fn set_view(&mut self, fov: f64, rays: usize) -> PyResult<()> {
+        if rays == 0 || !(fov > 0.0) {
+            return Err(PyValueError::new_err("the view needs a positive fov and ray count"));
+        }
+        self.view = Arc::new(RayFan::new(fov, rays as f64));
+        Ok(())
+    }
+
+    #[getter]
+    fn obs_fov(&self) -> f64 {
+        self.view.fov
+    }
+
+    #[getter]
+    fn obs_rays(&self) -> usize {
+        self.view.offsets.len()
+    }
+
+    #[getter]
+    fn obs_size(&self) -> usize {
+        obs_size(self.obs_rays())
+    }
+
+    fn observe_into(&mut self, py: Python, buffer: &PyAny) -> PyResult<()> {
+        let buffer = PyBuffer::<f32>::get(buffer)?;
+        let out = buffer_as_mut_slice(&buffer, self.obs_size())?;
+        py.allow_threads(|| self.observe(out));
+        Ok(())
+    }
+
+    fn fire_smoke(&mut self) {
+        if self.players[self.turn].smokes > 0 {
+            self.smokes.push(Smoke {
+                x: self.players[self.turn].x,
+                y: self.players[self.turn].y,
+                radius: self.smokes_radius,
+                rotation: self.players[self.turn].rotation,
+                frames_moved: 0,
+                opened: false,
+                frames_opened: 0,
+            });
+            self.players[self.turn].smokes -= 1;
+        }
+    }
+
+    fn smoke_tick(&mut self, py: Python) {
+        py.allow_threads(|| self.tick_smokes())
+    }
+
+    fn fire_flash(&mut self) {
+        if self.players[self.turn].flashes > 0 {
+            self.flashes.push(Flashbang {
+                x: self.players[self.turn].x,
+                y: self.players[self.turn].y,
+                rotation: self.players[self.turn].rotation,
+                frames_moved: 0,
+                opened: false,
+                frames_opened: 0,
+            });
+            self.players[self.turn].flashes -= 1;
+        }
+    }
+
+    fn flash_tick(&mut self, py: Python) {
+        py.allow_threads(|| self.tick_flashes())
+    }
+
+    fn set_rotation(&mut self, rotation: f64) {
+        self.players[self.turn].rotation = rotation
+    }
+
+    fn set_sound(&mut self, sound: f64) {
+        self.players[self.turn].sound = sound
+    }
+
+    fn set_memory_values(&mut self, value: Vec<f64>) {
+        self.players[self.turn].memory_values = value;
+    }
+
+    fn set_memory_keys(&mut self, value: Vec<f64>) {
+        self.players[self.turn].memory_keys = value;
+    }
+
+    /// Stores `(key, value)` in the newest memory slot of the player whose turn it is,
+    /// dropping the oldest one when all slots are full.
+    fn push_memory(&mut self, key: f64, value: f64) {
+        let player = &mut self.players[self.turn];
+        player.memory_values.insert(0, value);
+        player.memory_keys.insert(0, key);
+        if player.memory_values.len() > MEMORY_SLOTS {
+            player.memory_values.pop();
+            player.memory_keys.pop();
+        }
+    }
+
+    // Unlike the `players`/`bullets`/... getters, which clone every entity into a new
+    // Python object, these read single fields or copy packed rows into NumPy buffers.
+
+    /// `(x, y, rotation)` of player `index`, or of the player whose turn it is.
+    fn player_pose(&self, index: Option<usize>) -> PyResult<(f64, f64, f64)> {
+        let player = &self.players[self.player_index(index)?];
+        Ok((player.x, player.y, player.rotation))
+    }
+
+    fn player_ammo(&self, index: Option<usize>) -> PyResult<u8> {
+        Ok(self.players[self.player_index(index)?].ammo)
+    }
+
+    fn player_flashed(&self, index: Option<usize>) -> PyResult<bool> {
+        Ok(self.players[self.player_index(index)?].flashed)
+    }
+
+    #[getter]
+    fn num_players(&self) -> usize {
+        self.players.len()
+    }
+
+    #[getter]
+    fn teams(&self) -> Vec<usize> {
+        self.players.iter().map(|player| player.team).collect()
+    }
+
+    #[getter]
+    fn num_bullets(&self) -> usize {
+        self.bullets.len()
+    }
+
+    #[getter]
+    fn num_smokes(&self) -> usize {
+        self.smokes.len()
+    }
+
+    #[getter]
+    fn num_flashes(&self) -> usize {
+        self.flashes.len()
+    }
+
+    /// Rows of (x, y, rotation, ammo, sound, smokes, flashes, flashed) per player.
+    fn players_into(&self, buffer: &PyAny) -> PyResult<()> {
+        write_rows(buffer, &self.players, Player::row)
+    }
+
+    /// Rows of (x, y, rotation, fired_by) per bullet.
+    fn bullets_into(&self, buffer: &PyAny) -> PyResult<()> {
+        write_rows(buffer, &self.bullets, Bullet::row)
+    }
+
+    /// Rows of (x, y, radius, opened) per smoke.
+    fn smokes_into(&self, buffer: &PyAny) -> PyResult<()> {
+        write_rows(buffer, &self.smokes, Smoke::row)
+    }
+
+    /// Rows of (x, y, opened) per flashbang.
+    fn flashes_into(&self, buffer: &PyAny) -> PyResult<()> {
+        write_rows(buffer, &self.flashes, Flashbang::row)
+    }
+}
+
+impl Utils {
+    fn with_teams(walls: Vec<Vec<u8>>, team_sizes: &[usize], spawns: Option<Vec<(f64, f64, f64)>>) -> PyResult<Self> {
+        if team_sizes.iter().filter(|&&size| size > 0).count() < 2 {
+            return Err(PyValueError::new_err("a match needs players in at least two teams"));
+        }
+        let teams = seat_teams(team_sizes);
+
+        let mut utils = Self {
+            map: MapIndex::of(walls),
+            ray_engine: RayEngine::March,
+            view: Arc::new(RayFan::new(OBS_FOV, OBS_RAYS as f64)),
+            fan: Arc::new(RayFan::new(OBS_FOV, OBS_RAYS as f64)),
+            parallel_rays: false,
+            wall_cache: true,
+            wall_layers: Vec::new(),
+            wall_width: 1,
+            wall_height: 1,
+            bullets: Vec::new(),
+            player_width: 1,
+            player_height: 1,
+            ammo_total: 30,
+            players: Vec::new(),
+            start: Vec::new(),
+            turn: 0,
+            smokes: vec![],
+            flashes: vec![],
+            smokes_radius: 2.0,
+            smokes_max_move: 5,
+            smokes_max_open: 180,
+            flash_blind: 15,
+            flash_max_move: 5,
+            flash_max_open: 5,
+            flash_max_distance: 7.0,
+        };
+
+        let spawns = match spawns {
+            Some(spawns) => {
+                if spawns.len() != teams.len() {
+                    return Err(PyValueError::new_err(format!(
+                        "expected {} spawns, got {}",
+                        teams.len(),
+                        spawns.len()
+                    )));
+                }
+                for &(x, y, _) in &spawns {
+                    utils.check_spawn(x, y)?;
                 }
+                spawns
             }
+            None => utils.default_spawns(&teams)?,
+        };
+
+        utils.start = teams
+            .iter()
+            .zip(spawns)
+            .map(|(&team, (x, y, rotation))| Player {
+                x,
+                y,
+                rotation,
+                ammo: utils.ammo_total,
+                sound: 0.0,
+                memory_values: Vec::new(),
+                memory_keys: Vec::new(),
+                smokes: 3,
+                flashed: false,
+                flashed_for: 0,
+                flashes: 2,
+                team,
+            })
+            .collect();
+        utils.players = utils.start.clone();
+        Ok(utils)
+    }
+
+    fn check_spawn(&self, x: f64, y: f64) -> PyResult<()> {
+        if self.is_colliding_with_wall(x, y, self.player_width, self.player_height).0 {
+            return Err(PyValueError::new_err(format!("spawn ({}, {}) is inside a wall", x, y)));
+        }
+        Ok(())
+    }
+
+    /// Team 0 starts at (9, 11) facing 270 degrees and team 1 at (1, 1) facing 90. Each
+    /// team's first member takes its spawn, and the others the free cells closest to it
+    /// that nobody has taken yet, facing the same way.
+    fn default_spawns(&self, teams: &[usize]) -> PyResult<Vec<(f64, f64, f64)>> {
+        const SPAWNS: [(f64, f64, f64); 2] = [(9.0, 11.0, 270.0), (1.0, 1.0, 90.0)];
+        if teams.iter().any(|&team| team >= SPAWNS.len()) {
+            return Err(PyValueError::new_err("matches with more than two teams need spawns"));
         }
 
-        players_hit
+        let free: Vec<(f64, f64)> = self
+            .map
+            .walls
+            .iter()
+            .enumerate()
+            .flat_map(|(y, row)| row.iter().enumerate().filter(|&(_, &cell)| cell == 0).map(move |(x, _)| (x as f64, y as f64)))
+            .collect();
+        let mut taken: Vec<(f64, f64)> = Vec::new();
+        let mut spawns = Vec::with_capacity(teams.len());
+
+        for (seat, &team) in teams.iter().enumerate() {
+            let (x, y, rotation) = SPAWNS[team];
+            let first = !teams[..seat].contains(&team);
+            let cell = if first {
+                (x, y)
+            } else {
+                // `free` is in row-major order and the sort is stable, so ties go to the
+                // first cell in it.
+                let mut nearest: Vec<&(f64, f64)> = free.iter().filter(|cell| !taken.contains(cell)).collect();
+                nearest.sort_by(|a, b| self.distance(x, y, a.0, a.1).total_cmp(&self.distance(x, y, b.0, b.1)));
+                match nearest.first() {
+                    Some(&&cell) => cell,
+                    None => return Err(PyValueError::new_err("not enough free cells to spawn every player")),
+                }
+            };
+            taken.push(cell);
+            spawns.push((cell.0, cell.1, rotation));
+        }
+        Ok(spawns)
     }
 
-    fn next_turn(&mut self) {
-        self.turn = (self.turn + 1) % self.players.len();
+    fn save_into(&self, snapshot: &mut Snapshot) {
+        snapshot.map.clone_from(&self.map);
+        snapshot.players.clone_from(&self.players);
+        snapshot.bullets.clone_from(&self.bullets);
+        snapshot.smokes.clone_from(&self.smokes);
+        snapshot.flashes.clone_from(&self.flashes);
+        snapshot.turn = self.turn;
     }
 
-    fn distance(&self, x: f64, y: f64, x2: f64, y2: f64) -> f64 {
-        sqrt(pow(x - x2, 2.0) + pow(y - y2, 2.0))
+    fn restore_from(&mut self, snapshot: &Snapshot) -> PyResult<()> {
+        if !Arc::ptr_eq(&self.map, &snapshot.map) {
+            return Err(PyValueError::new_err("the snapshot was taken on another map"));
+        }
+
+        self.players.clone_from(&snapshot.players);
+        self.bullets.clone_from(&snapshot.bullets);
+        self.smokes.clone_from(&snapshot.smokes);
+        self.flashes.clone_from(&snapshot.flashes);
+        self.turn = snapshot.turn;
+        Ok(())
     }
 
-    fn ray(&mut self, x: f64, y: f64, rotation: f64) -> (f64, u8) {
-        let forward = self.forward(rotation);
+    fn player_index(&self, index: Option<usize>) -> PyResult<usize> {
+        let index = index.unwrap_or(self.turn);
+        if index >= self.players.len() {
+            return Err(PyIndexError::new_err("player index out of range"));
+        }
+        Ok(index)
+    }
 
+    /// The first wall a marching ray steps into. A ray that leaves the map without one
+    /// gets no distance and an unbounded number of steps, so only entities can stop it.
+    fn march_wall(&self, x: f64, y: f64, forward: (f64, f64)) -> WallHit {
+        let (width, height) = (self.map.zones.width as f64, self.map.zones.height as f64);
         let mut x_cur = x;
         let mut y_cur = y;
+        let mut steps = 0;
+        // How much further the ray is known to stay clear of walls. Steps are one unit
+        // long, so the wall checks are skipped for as many steps as the clearance allows.
+        let mut clear = 0.0;
 
         loop {
             x_cur += forward.0;
             y_cur += forward.1;
+            steps += 1;
+
+            // Out there no wall can collide with the ray any more.
+            if (x_cur < -1.0 && forward.0 <= 0.0)
+                || (x_cur > width && forward.0 >= 0.0)
+                || (y_cur < -1.0 && forward.1 <= 0.0)
+                || (y_cur > height && forward.1 >= 0.0)
+            {
+                return WallHit { distance: None, steps: usize::MAX };
+            }
+
+            clear -= 1.0;
+            if clear > 0.0 {
+                continue;
+            }
 
             let collision_wall = self.is_colliding_with_wall(x_cur, y_cur, 1, 1);
             if collision_wall.0 {
-                return (self.distance(x, y, collision_wall.1, collision_wall.2), 0);
-            }
-
-            let collision_player = self.is_colliding_with_any_player(x_cur, y_cur, 1, 1);
-            if collision_player.0 {
-                if !self.is_colliding_with_player(
-                    self.players[self.turn].clone(),
-                    x_cur,
-                    y_cur,
-                    1,
-                    1,
-                ) {
-                    return (
-                        self.distance(x, y, collision_player.1, collision_player.2),
-                        1,
-                    );
+                return WallHit {
+                    distance: Some(self.distance(x, y, collision_wall.1, collision_wall.2)),
+                    steps,
+                };
+            }
+            clear = self.map.zones.clearance(x_cur, y_cur) - 1e-9;
+        }
+    }
+
+    /// Marches a ray, checking walls before the other entities on every step. `wall` is
+    /// the ray's `march_wall` if already known; only the steps before it are walked.
+    /// With `grid`, each step only tests the entities listed in its cell.
+    fn trace_march(&self, x: f64, y: f64, forward: (f64, f64), wall: Option<WallHit>, grid: Option<&EntityGrid>) -> (f64, u8, bool) {
+        let wall = wall.unwrap_or_else(|| self.march_wall(x, y, forward));
+        let mut x_cur = x;
+        let mut y_cur = y;
+
+        for _ in 1..wall.steps {
+            x_cur += forward.0;
+            y_cur += forward.1;
+
+            // Players are only seen once the ray has left the box of the player whose
+            // turn it is; before that, the first smoke or flashbang touched stops it.
+            let inside_me = self.touches(Entity::Player(self.turn), x_cur, y_cur);
+            let stops = |entity: &Entity| !(inside_me && matches!(entity, Entity::Player(_))) && self.touches(*entity, x_cur, y_cur);
+            let hit = match grid {
+                Some(grid) => grid.at(x_cur, y_cur).iter().copied().find(stops),
+                None => self.entities().find(stops),
+            };
+
+            if let Some(entity) = hit {
+                let (entity_x, entity_y) = self.entity_position(entity);
+                let distance = self.distance(x, y, entity_x, entity_y);
+                return match entity {
+                    Entity::Player(_) => (distance, 1, false),
+                    Entity::Smoke(_) => (distance, 2, false),
+                    Entity::Flash(_) => (distance, 3, distance < self.flash_max_distance),
+                };
+            }
+        }
+        (wall.distance.unwrap_or(0.0), 0, false)
+    }
+
+    fn dda_wall(&self, x: f64, y: f64, forward: (f64, f64)) -> WallHit {
+        let (dx, dy) = dda_direction(forward);
+        WallHit {
+            distance: self.map.zones.cast(x, y, dx, dy, f64::INFINITY),
+            steps: 0,
+        }
+    }
+
+    /// Traces a ray analytically. `wall` is the ray's `dda_wall` if already known, which
+    /// saves walking the wall grid. With `grid`, only the entities listed in the cells
+    /// the ray crosses before its hit are tested.
+    fn trace_dda(&self, x: f64, y: f64, forward: (f64, f64), wall: Option<WallHit>, grid: Option<&EntityGrid>) -> (f64, u8, bool) {
+        let (dx, dy) = dda_direction(forward);
+
+        // Like `ray_march`, players are only seen once the ray has left the box of the
+        // player whose turn it is.
+        let (reach_x, reach_y) = self.player_reach();
+        let me = &self.players[self.turn];
+        let own = ray_box(x, y, dx, dy, me.x, me.y, reach_x, reach_y);
+
+        // The nearest entity, ties going to the one a scan of players, then smokes, then
+        // flashbangs meets first.
+        let mut nearest: Option<(f64, Entity)> = None;
+        let mut consider = |entities: &mut dyn Iterator<Item = Entity>| {
+            for entity in entities {
+                if let Some(t) = self.entity_entry(x, y, dx, dy, own, entity) {
+                    let closer = match nearest {
+                        None => t < f64::INFINITY,
+                        Some((best, first)) => t < best || (t == best && entity < first),
+                    };
+                    if closer {
+                        nearest = Some((t, entity));
+                    }
                 }
             }
+            nearest.map_or(f64::INFINITY, |(t, _)| t)
+        };
+        match grid {
+            Some(grid) => {
+                // Nothing behind a known wall can be seen.
+                let limit = wall.and_then(|wall| wall.distance).unwrap_or(f64::INFINITY);
+                grid.walk(x, y, dx, dy, limit, |entities| consider(&mut entities.iter().copied()));
+            }
+            None => {
+                consider(&mut self.entities());
+            }
+        }
+        let hit = nearest.map_or(f64::INFINITY, |(t, _)| t);
+
+        // A wall is in front of everything else exactly when the grid walk, cut off at
+        // the nearest entity, still reaches it.
+        let wall = match wall {
+            Some(wall) => wall.distance.filter(|&t| t <= hit),
+            None => self.map.zones.cast(x, y, dx, dy, hit),
+        };
+        if let Some(t) = wall {
+            return (t, 0, false);
+        }
 
-            let collision_smoke = self.is_colliding_with_smoke(x_cur, y_cur, 1, 1);
-            if collision_smoke.0 {
-                return (self.distance(x, y, collision_smoke.1, collision_smoke.2), 2);
+        match nearest {
+            None => {
+                // Nothing but the edge of an open map: stop the ray there.
+                let (width, height) = (self.map.zones.width as f64, self.map.zones.height as f64);
+                let edge = ray_box(x, y, dx, dy, (width - 1.0) / 2.0, (height - 1.0) / 2.0, (width + 1.0) / 2.0, (height + 1.0) / 2.0);
+                (edge.map_or(0.0, |(_, exit)| exit.max(0.0)), 0, false)
+            }
+            Some((t, Entity::Player(_))) => (t, 1, false),
+            Some((t, Entity::Smoke(_))) => (t, 2, false),
+            Some((t, Entity::Flash(i))) => {
+                let flash = &self.flashes[i];
+                (t, 3, self.distance(x, y, flash.x, flash.y) < self.flash_max_distance)
             }
+        }
+    }
 
-            let collision_flash = self.is_colliding_with_flashbang(x_cur, y_cur, 1, 1);
-            if collision_flash.0 {
-                if self.distance(x, y, collision_flash.1, collision_flash.2) < self.flash_max_distance {
-                    self.players[self.turn].flashed = true;
+    /// Where the ray `o + t * d` first enters the region of `entity`, as in `trace_dda`.
+    fn entity_entry(&self, x: f64, y: f64, dx: f64, dy: f64, own: Option<(f64, f64)>, entity: Entity) -> Option<f64> {
+        match entity {
+            Entity::Player(i) => {
+                if i == self.turn {
+                    return None;
+                }
+                let player = &self.players[i];
+                let (reach_x, reach_y) = self.player_reach();
+                let (enter, exit) = ray_box(x, y, dx, dy, player.x, player.y, reach_x, reach_y)?;
+                let mut t = enter.max(0.0);
+                if let Some((own_enter, own_exit)) = own {
+                    if t >= own_enter && t < own_exit {
+                        t = own_exit;
+                    }
                 }
-                return (self.distance(x, y, collision_flash.1, collision_flash.2), 3);
+                (t < exit).then_some(t)
+            }
+            Entity::Smoke(i) => {
+                // Where a unit box is within `radius` of the smoke: the square of box
+                // positions touching its center, rounded by `radius`.
+                let smoke = &self.smokes[i];
+                let r = self.smokes_radius;
+                let (cx, cy) = (smoke.x - 0.5, smoke.y - 0.5);
+                first_entry(&[
+                    ray_box(x, y, dx, dy, cx, cy, 0.5 + r, 0.5),
+                    ray_box(x, y, dx, dy, cx, cy, 0.5, 0.5 + r),
+                    ray_circle(x, y, dx, dy, smoke.x - 1.0, smoke.y - 1.0, r),
+                    ray_circle(x, y, dx, dy, smoke.x, smoke.y - 1.0, r),
+                    ray_circle(x, y, dx, dy, smoke.x - 1.0, smoke.y, r),
+                    ray_circle(x, y, dx, dy, smoke.x, smoke.y, r),
+                ])
+            }
+            Entity::Flash(i) => {
+                let flash = &self.flashes[i];
+                first_entry(&[ray_box(x, y, dx, dy, flash.x, flash.y, 1.0, 1.0)])
             }
         }
     }
 
-    fn ray_fov(&mut self, fov: f64, number_of_rays: f64) -> Vec<(f64, u8)> {
-        let mut results = vec![];
-        let mut rotation_traveled = 0.0;
-        let rotation_per = fov / number_of_rays;
-        let half = fov / 2.0;
-        let mut count = -half;
+    /// Half extents of the positions at which a unit box collides with a player.
+    fn player_reach(&self) -> (f64, f64) {
+        ((1.0 + self.player_width as f64) / 2.0, (1.0 + self.player_height as f64) / 2.0)
+    }
+
+    /// The players, opened smokes and opened flashbangs, in `Entity` order.
+    fn entities(&self) -> impl Iterator<Item = Entity> + '_ {
+        let smokes = self.smokes.iter().enumerate().filter(|(_, smoke)| smoke.opened);
+        let flashes = self.flashes.iter().enumerate().filter(|(_, flash)| flash.opened);
+        (0..self.players.len())
+            .map(Entity::Player)
+            .chain(smokes.map(|(i, _)| Entity::Smoke(i)))
+            .chain(flashes.map(|(i, _)| Entity::Flash(i)))
+    }
 
-        while rotation_traveled < fov {
-            results.push(self.ray(
-                self.players[self.turn].x,
-                self.players[self.turn].y,
-                self.players[self.turn].rotation + count,
-            ));
-            count += rotation_per;
-            rotation_traveled += rotation_per;
+    fn entity_position(&self, entity: Entity) -> (f64, f64) {
+        match entity {
+            Entity::Player(i) => (self.players[i].x, self.players[i].y),
+            Entity::Smoke(i) => (self.smokes[i].x, self.smokes[i].y),
+            Entity::Flash(i) => (self.flashes[i].x, self.flashes[i].y),
         }
+    }
 
-        results
+    /// Whether a unit box at `(x, y)` collides with `entity`.
+    fn touches(&self, entity: Entity, x: f64, y: f64) -> bool {
+        match entity {
+            Entity::Player(i) => {
+                let player = &self.players[i];
+                self.colliding(x, y, 1, 1, player.x, player.y, self.player_width, self.player_height)
+            }
+            Entity::Smoke(i) => {
+                let smoke = &self.smokes[i];
+                smoke.opened && self.colliding_circle(x, y, 1, 1, smoke.x, smoke.y, self.smokes_radius)
+            }
+            Entity::Flash(i) => {
+                let flash = &self.flashes[i];
+                flash.opened && self.colliding(x, y, 1, 1, flash.x, flash.y, 1, 1)
+            }
+        }
     }
 
-    fn fire_smoke(&mut self) {
-        if self.players[self.turn].smokes > 0 {
-            self.smokes.push(Smoke {
-                x: self.players[self.turn].x,
-                y: self.players[self.turn].y,
-                radius: self.smokes_radius,
-                rotation: self.players[self.turn].rotation,
-                frames_moved: 0,
-                opened: false,
-                frames_opened: 0,
-            });
-            self.players[self.turn].smokes -= 1;
+    /// The spatial hash for a fan of rays, when there are enough entities for it to pay.
+    fn entity_grid(&self) -> Option<EntityGrid> {
+        let utilities = self.entities().count() - self.players.len();
+        if self.players.len() + GRID_UTILITY_COST * utilities < GRID_MIN_COST {
+            return None;
         }
+        EntityGrid::new(self, true)
     }
 
-    fn smoke_tick(&mut self) {
-        let mut smokes: Vec<Smoke> = vec![];
+    fn trace(&self, x: f64, y: f64, rotation: f64) -> (f64, u8, bool) {
+        self.trace_towards(x, y, self.forward(rotation), None, None)
+    }
 
-        for i in 0..self.smokes.len() {
-            if self.smokes[i].frames_moved < self.smokes_max_move && !self.smokes[i].opened {
-                let forward = self.forward(self.smokes[i].rotation);
-                self.smokes[i].frames_moved += 1;
+    fn trace_towards(&self, x: f64, y: f64, forward: (f64, f64), wall: Option<WallHit>, grid: Option<&EntityGrid>) -> (f64, u8, bool) {
+        match self.ray_engine {
+            RayEngine::March => self.trace_march(x, y, forward, wall, grid),
+            RayEngine::Dda => self.trace_dda(x, y, forward, wall, grid),
+        }
+    }
+
+    fn wall_towards(&self, x: f64, y: f64, forward: (f64, f64)) -> WallHit {
+        match self.ray_engine {
+            RayEngine::March => self.march_wall(x, y, forward),
+            RayEngine::Dda => self.dda_wall(x, y, forward),
+        }
+    }
+
+    /// The wall hits of `fan` for the player whose turn it is, from their last cast when
+    /// they have not moved or turned since.
+    fn wall_layer(&mut self, fan: &RayFan, directions: &[(f64, f64)]) -> Arc<WallLayer> {
+        let player = &self.players[self.turn];
+        let pose = (player.x, player.y, player.rotation);
+        if let Some(Some(layer)) = self.wall_layers.get(self.turn) {
+            if layer.is(pose, fan, self.ray_engine) {
+                return layer.clone();
+            }
+        }
 
-                self.smokes[i].x += forward.0;
-                self.smokes[i].y += forward.1;
+        let this = &*self;
+        let hits = if this.parallel_rays {
+            directions.par_iter().map(|&forward| this.wall_towards(pose.0, pose.1, forward)).collect()
+        } else {
+            directions.iter().map(|&forward| this.wall_towards(pose.0, pose.1, forward)).collect()
+        };
+        let layer = Arc::new(WallLayer {
+            pose,
+            fov: fan.fov,
+            rays: fan.rays,
+            engine: self.ray_engine,
+            hits,
+        });
+
+        if self.wall_layers.len() <= self.turn {
+            self.wall_layers.resize(self.turn + 1, None);
+        }
+        self.wall_layers[self.turn] = Some(layer.clone());
+        layer
+    }
+
+    fn flash_if(&mut self, flashed: bool) {
+        if flashed {
+            self.players[self.turn].flashed = true;
+        }
+    }
+
+    /// The grid of the players for checking bullets against them, when there are enough
+    /// player and bullet pairs for it to pay. The world must not change while it is used.
+    fn bullet_grid(&self) -> Option<EntityGrid> {
+        if self.players.len() * self.bullets.len() < GRID_MIN_PAIRS {
+            return None;
+        }
+        EntityGrid::new(self, false)
+    }
 
-                if self.is_smoke_colliding_with_wall(self.smokes[i].x, self.smokes[i].y, 0.1) {
-                    self.smokes[i].x -= forward.0;
-                    self.smokes[i].y -= forward.1;
-                    self.smokes[i].frames_moved = self.smokes_max_move;
+    /// The players hit by a bullet someone else fired, once per such bullet, ordered by
+    /// player and then bullet. With `grid` (see `bullet_grid`), each bullet is only
+    /// checked against the players listed in its cell.
+    fn players_hit(&self, grid: Option<&EntityGrid>) -> Vec<usize> {
+        let Some(grid) = grid else {
+            let mut players_hit = vec![];
+            for i in 0..self.players.len() {
+                for bullet in self.bullets.iter() {
+                    if bullet.fired_by != i && self.touches(Entity::Player(i), bullet.x, bullet.y) {
+                        players_hit.push(i);
+                    }
+                }
+            }
+            return players_hit;
+        };
+
+        let mut hits = vec![];
+        for (j, bullet) in self.bullets.iter().enumerate() {
+            for &entity in grid.at(bullet.x, bullet.y) {
+                if let Entity::Player(i) = entity {
+                    if bullet.fired_by != i && self.touches(entity, bullet.x, bullet.y) {
+                        hits.push((i, j));
+                    }
                 }
+            }
+        }
+        hits.sort_unstable();
+        hits.into_iter().map(|(i, _)| i).collect()
+    }
 
-                smokes.push(self.smokes[i].clone());
-            } else if self.smokes[i].opened {
-                self.smokes[i].frames_opened += 1;
-                smokes.push(self.smokes[i].clone());
+    fn apply_action(&mut self, action: &[f32]) {
+        self.tick_bullets();
+        self.tick_smokes();
+        self.tick_flashes();
 
-                if self.smokes[i].frames_opened > self.smokes_max_open {
-                    smokes.pop();
+        if action[2] > 0.0 {
+            self.player_move(action[0] as f64, action[1] as f64);
+        }
+        if action[3] > 0.0 {
+            self.fire_bullet();
+        }
+        if action[5] > 0.0 {
+            self.set_rotation((self.players[self.turn].rotation + action[4] as f64).rem_euclid(360.0));
+        }
+        if action[7] > 0.0 {
+            self.push_memory(action[8] as f64, action[9] as f64);
+        }
+        if action[10] > 0.0 {
+            self.fire_smoke();
+        }
+        if action[11] > 0.0 {
+            self.fire_flash();
+        }
+    }
+
+    /// Bonus for the player whose turn it is: 5 per bullet within 1 of an opponent, 5
+    /// per opponent within 5 degrees of their aim, and -5 when out of ammo. With `grid`
+    /// (see `bullet_grid`), each bullet is only checked against the players in its cell.
+    fn shaping_reward(&self, grid: Option<&EntityGrid>) -> f64 {
+        let me = &self.players[self.turn];
+        let mut reward = 0.0;
+
+        let near = |bullet: &Bullet, player: &Player| {
+            player.team != me.team && self.distance(bullet.x, bullet.y, player.x, player.y) <= 1.0
+        };
+        // A player's region in the grid holds every point within 1 of them as long as
+        // their reach is at least 1, which it is for any player size.
+        let (reach_x, reach_y) = self.player_reach();
+        match grid.filter(|_| reach_x >= 1.0 && reach_y >= 1.0) {
+            Some(grid) => {
+                for bullet in self.bullets.iter() {
+                    for &entity in grid.at(bullet.x, bullet.y) {
+                        if let Entity::Player(i) = entity {
+                            if near(bullet, &self.players[i]) {
+                                reward += 5.0;
+                            }
+                        }
+                    }
+                }
+            }
+            None => {
+                for bullet in self.bullets.iter() {
+                    for player in self.players.iter() {
+                        if near(bullet, player) {
+                            reward += 5.0;
+                        }
+                    }
                 }
-            } else {
-                self.smokes[i].opened = true;
-                smokes.push(self.smokes[i].clone());
             }
         }
 
-        self.smokes = smokes;
+        for player in self.players.iter() {
+            if player.team != me.team {
+                let angle = atan2(-(player.y - me.y), player.x - me.x).to_degrees() + 90.0;
+                if fabs((angle - me.rotation + 180.0).rem_euclid(360.0) - 180.0) <= 5.0 {
+                    reward += 5.0;
+                }
+            }
+        }
+
+        if me.ammo == 0 {
+            reward -= 5.0;
+        }
+
+        reward
     }
 
-    fn fire_flash(&mut self) {
-        if self.players[self.turn].flashes > 0 {
-            self.flashes.push(Flashbang {
-                x: self.players[self.turn].x,
-                y: self.players[self.turn].y,
-                rotation: self.players[self.turn].rotation,
-                frames_moved: 0,
-                opened: false,
-                frames_opened: 0,
-            });
-            self.players[self.turn].flashes -= 1;
+    /// Plays `action` for the player whose turn it is as one turn of a ShooterEnv step,
+    /// which goes round every seat, where `learner` is the player trained on. Returns the
+    /// learner's reward for this turn and whether the match is over.
+    fn play_turn(&mut self, action: &[f32], learner: usize) -> (f64, bool) {
+        let acting = self.turn;
+        let mut reward = 0.0;
+
+        self.apply_action(action);
+        // The reward and the hits look at the same world, so they share one grid.
+        let grid = self.bullet_grid();
+        if acting == learner {
+            reward += self.shaping_reward(grid.as_ref());
+        }
+
+        let hits = self.players_hit(grid.as_ref());
+        let done = !hits.is_empty();
+
+        if done {
+            // The match is decided by whether player 0's team was hit.
+            let first_team = self.players[0].team;
+            let first_team_hit = hits.iter().any(|&i| self.players[i].team == first_team);
+            let learner_first_team = self.players[learner].team == first_team;
+            reward += if first_team_hit == learner_first_team { -100.0 } else { 100.0 };
+
+            if acting == learner && self.players[acting].ammo == self.ammo_total {
+                reward -= 25.0;
+            }
         }
+
+        // A learner moving first that ends the match keeps the turn.
+        if !(done && acting == learner && learner == 0) {
+            self.next_turn();
+        }
+
+        (reward, done)
+    }
+
+    /// See `repeat_actions`. The rounds start from the seat whose turn it is, which is
+    /// seat 0 after a whole step.
+    fn play_rounds(&mut self, actions: &[f32], learner: usize, rounds: usize) -> (f64, bool) {
+        let mut reward = 0.0;
+        for _ in 0..rounds {
+            for _ in 0..self.players.len() {
+                let seat = self.turn;
+                let (turn_reward, done) = self.play_turn(&actions[seat * ACTION_SIZE..(seat + 1) * ACTION_SIZE], learner);
+                reward += turn_reward;
+                if done {
+                    return (reward, true);
+                }
+            }
+        }
+        (reward, false)
+    }
+
+    fn cast_fov(&mut self, fov: f64, number_of_rays: f64) -> Vec<(f64, u8)> {
+        let fan = if self.view.is(fov, number_of_rays) {
+            self.view.clone()
+        } else {
+            if !self.fan.is(fov, number_of_rays) {
+                self.fan = Arc::new(RayFan::new(fov, number_of_rays));
+            }
+            self.fan.clone()
+        };
+
+        let (x, y) = (self.players[self.turn].x, self.players[self.turn].y);
+        let directions: Vec<(f64, f64)> = fan.directions(self.players[self.turn].rotation).collect();
+        let layer = if self.wall_cache { Some(self.wall_layer(&fan, &directions)) } else { None };
+        let wall = |i: usize| layer.as_ref().map(|layer| layer.hits[i]);
+        let grid = self.entity_grid();
+        let grid = grid.as_ref();
+
+        // Rays only read the world, so they can be traced on rayon's thread pool.
+        let this = &*self;
+        let hits: Vec<(f64, u8, bool)> = if this.parallel_rays {
+            directions.into_par_iter().enumerate().map(|(i, forward)| this.trace_towards(x, y, forward, wall(i), grid)).collect()
+        } else {
+            directions.into_iter().enumerate().map(|(i, forward)| this.trace_towards(x, y, forward, wall(i), grid)).collect()
+        };
+
+        self.flash_if(hits.iter().any(|hit| hit.2));
+        hits.into_iter().map(|hit| (hit.0, hit.1)).collect()
+    }
+
+    // The tick functions update entities in place and drop expired ones with `retain_mut`,
+    // so a tick reuses the existing vectors instead of rebuilding them. Each vector is
+    // taken out of `self` for the duration of the tick so the wall checks can borrow the
+    // rest of the world; `mem::take` leaves an empty, unallocated vector behind.
+
+    fn tick_bullets(&mut self) {
+        let mut bullets = std::mem::take(&mut self.bullets);
+
+        bullets.retain_mut(|bullet| {
+            let forward = self.forward(bullet.rotation);
+            bullet.x += forward.0;
+            bullet.y += forward.1;
+
+            !self.is_colliding_with_wall(bullet.x, bullet.y, 1, 1).0
+        });
+
+        self.bullets = bullets;
     }
 
-    fn flash_tick(&mut self) {
-        let mut flashes: Vec<Flashbang> = vec![];
+    fn tick_smokes(&mut self) {
+        let mut smokes = std::mem::take(&mut self.smokes);
+
+        smokes.retain_mut(|smoke| {
+            if smoke.frames_moved < self.smokes_max_move && !smoke.opened {
+                let forward = self.forward(smoke.rotation);
+                smoke.frames_moved += 1;
 
+                smoke.x += forward.0;
+                smoke.y += forward.1;
+
+                if self.is_smoke_colliding_with_wall(smoke.x, smoke.y, 0.1) {
+                    smoke.x -= forward.0;
+                    smoke.y -= forward.1;
+                    smoke.frames_moved = self.smokes_max_move;
+                }
+            } else if smoke.opened {
+                smoke.frames_opened += 1;
+                return smoke.frames_opened <= self.smokes_max_open;
+            } else {
+                smoke.opened = true;
+            }
+
+            true
+        });
+
+        self.smokes = smokes;
+    }
+
+    fn tick_flashes(&mut self) {
         for player in self.players.iter_mut() {
             if player.flashed {
                 player.flashed_for += 1;
@@ -581,51 +2095,280 @@ impl Utils {
             }
         }
 
-        for i in 0..self.flashes.len() {
-            if self.flashes[i].frames_moved < self.flash_max_move && !self.flashes[i].opened {
-                let forward = self.forward(self.flashes[i].rotation);
-                self.flashes[i].frames_moved += 1;
-
-                self.flashes[i].x += forward.0;
-                self.flashes[i].y += forward.1;
+        let mut flashes = std::mem::take(&mut self.flashes);
 
-                if self.is_colliding_with_wall(self.flashes[i].x, self.flashes[i].y, 1, 1).0 {
-                    self.flashes[i].x -= forward.0;
-                    self.flashes[i].y -= forward.1;
-                    self.flashes[i].frames_moved = self.flash_max_move;
-                }
+        flashes.retain_mut(|flash| {
+            if flash.frames_moved < self.flash_max_move && !flash.opened {
+                let forward = self.forward(flash.rotation);
+                flash.frames_moved += 1;
 
-                flashes.push(self.flashes[i].clone());
-            } else if self.flashes[i].opened {
-                self.flashes[i].frames_opened += 1;
-                flashes.push(self.flashes[i].clone());
+                flash.x += forward.0;
+                flash.y += forward.1;
 
-                if self.flashes[i].frames_opened > self.flash_max_open {
-                    flashes.pop();
+                if self.is_colliding_with_wall(flash.x, flash.y, 1, 1).0 {
+                    flash.x -= forward.0;
+                    flash.y -= forward.1;
+                    flash.frames_moved = self.flash_max_move;
                 }
+            } else if flash.opened {
+                flash.frames_opened += 1;
+                return flash.frames_opened <= self.flash_max_open;
             } else {
-                self.flashes[i].opened = true;
-                flashes.push(self.flashes[i].clone());
+                flash.opened = true;
             }
-        }
+
+            true
+        });
 
         self.flashes = flashes;
     }
 
-    fn set_rotation(&mut self, rotation: f64) {
-        self.players[self.turn].rotation = rotation
+    fn observe(&mut self, out: &mut [f32]) {
+        let view = self.view.clone();
+        let rays = self.cast_fov(view.fov, view.rays);
+        let ray_values = rays.len() * 2;
+        for (i, ray) in rays.iter().enumerate() {
+            out[i * 2] = ray.0 as f32;
+            out[i * 2 + 1] = ray.1 as f32;
+        }
+
+        let player = &self.players[self.turn];
+        if player.flashed {
+            for ray in out[..ray_values].chunks_exact_mut(2) {
+                ray[0] = 0.0;
+                ray[1] = -1.0;
+            }
+        }
+
+        let rest = &mut out[ray_values..];
+        rest[0] = player.x as f32;
+        rest[1] = player.y as f32;
+        rest[2] = player.rotation as f32;
+        rest[3] = player.ammo as f32;
+        for slot in 0..MEMORY_SLOTS {
+            rest[4 + slot * 2] = *player.memory_keys.get(slot).unwrap_or(&0.0) as f32;
+            rest[5 + slot * 2] = *player.memory_values.get(slot).unwrap_or(&0.0) as f32;
+        }
+        let tail = &mut rest[4 + MEMORY_SLOTS * 2..];
+        tail[0] = player.sound as f32;
+        tail[1] = player.smokes as f32;
+        tail[2] = player.flashes as f32;
+        tail[3] = player.flashed as u8 as f32;
     }
+}
 
-    fn set_sound(&mut self, sound: f64) {
-        self.players[self.turn].sound = sound
+/// Many independent matches on the same map, stepped together.
+#[pyclass]
+struct WorldBatch {
+    // A fresh match with the batch's view, which every reset starts from.
+    template: Utils,
+    worlds: Vec<Utils>,
+    learners: Vec<usize>,
+}
+
+#[pymethods]
+impl WorldBatch {
+    /// `size` worlds on `walls` with the view, teams and ray engine of `Utils.set_view`,
+    /// `Utils` and `Utils.ray_engine`.
+    #[new]
+    fn new(
+        walls: Vec<Vec<u8>>,
+        size: usize,
+        fov: Option<f64>,
+        rays: Option<usize>,
+        team_sizes: Option<Vec<usize>>,
+        spawns: Option<Vec<(f64, f64, f64)>>,
+        ray_engine: Option<&str>,
+    ) -> PyResult<Self> {
+        let mut template = Utils::py_new(walls, team_sizes, spawns)?;
+        template.set_view(fov.unwrap_or(OBS_FOV), rays.unwrap_or(OBS_RAYS))?;
+        if let Some(engine) = ray_engine {
+            template.set_ray_engine(engine)?;
+        }
+
+        Ok(Self {
+            worlds: vec![template.clone(); size],
+            learners: vec![0; size],
+            template,
+        })
     }
 
-    fn set_memory_values(&mut self, value: Vec<f64>) {
-        self.players[self.turn].memory_values = value;
+    #[getter]
+    fn obs_size(&self) -> usize {
+        self.template.obs_size()
     }
 
-    fn set_memory_keys(&mut self, value: Vec<f64>) {
-        self.players[self.turn].memory_keys = value;
+    #[getter]
+    fn num_players(&self) -> usize {
+        self.template.players.len()
+    }
+
+    fn __len__(&self) -> usize {
+        self.worlds.len()
+    }
+
+    /// Starts a new match in world `index`, trained on as player `learner`; see
+    /// `Utils.reset`.
+    fn reset(&mut self, index: usize, learner: usize, spawns: Option<Vec<(f64, f64)>>) -> PyResult<()> {
+        self.check_index(index)?;
+        if learner >= self.template.players.len() {
+            return Err(PyIndexError::new_err("learner is not a player of the match"));
+        }
+
+        self.worlds[index].reset(spawns)?;
+        self.learners[index] = learner;
+        Ok(())
+    }
+
+    /// A copy of world `index`.
+    fn world(&self, index: usize) -> PyResult<Utils> {
+        self.check_index(index)?;
+        Ok(self.worlds[index].clone())
+    }
+
+    fn observe(&mut self, py: Python, index: usize, observation: &PyAny) -> PyResult<()> {
+        self.check_index(index)?;
+        let observation = PyBuffer::<f32>::get(observation)?;
+        let out = buffer_as_mut_slice(&observation, self.obs_size())?;
+        let world = &mut self.worlds[index];
+        py.allow_threads(|| world.observe(out));
+        Ok(())
+    }
+
+    fn observe_all(&mut self, py: Python, observations: &PyAny) -> PyResult<()> {
+        let observations = PyBuffer::<f32>::get(observations)?;
+        let obs_size = self.obs_size();
+        let out = buffer_as_mut_slice(&observations, self.worlds.len() * obs_size)?;
+
+        py.allow_threads(|| {
+            self.worlds
+                .par_iter_mut()
+                .zip(out.par_chunks_mut(obs_size))
+                .for_each(|(world, out)| world.observe(out))
+        });
+        Ok(())
+    }
+
+    /// Plays one turn in every world where `active` is set: `actions` (float32, one row
+    /// of 12 per world) for the player whose turn it is, then passes the turn on.
+    /// The next observation is only written where `observe` (uint8) is set or the match
+    /// ended, as casting it is most of a turn's cost and nobody may read it.
+    /// `rewards` (float32, for the learner) and `dones` (uint8) are written for every
+    /// world, and are 0 where `active` is not set.
+    fn step_all(
+        &mut self,
+        py: Python,
+        actions: &PyAny,
+        active: &PyAny,
+        observe: &PyAny,
+        rewards: &PyAny,
+        dones: &PyAny,
+        observations: &PyAny,
+    ) -> PyResult<()> {
+        let size = self.worlds.len();
+        let (actions, active) = (PyBuffer::<f32>::get(actions)?, PyBuffer::<u8>::get(active)?);
+        let observe = PyBuffer::<u8>::get(observe)?;
+        let (rewards, dones) = (PyBuffer::<f32>::get(rewards)?, PyBuffer::<u8>::get(dones)?);
+        let observations = PyBuffer::<f32>::get(observations)?;
+
+        let actions = buffer_as_slice(&actions, size * ACTION_SIZE)?;
+        let active = buffer_as_slice(&active, size)?;
+        let observe = buffer_as_slice(&observe, size)?;
+        let rewards = buffer_as_mut_slice(&rewards, size)?;
+        let dones = buffer_as_mut_slice(&dones, size)?;
+        let obs_size = self.obs_size();
+        let observations = buffer_as_mut_slice(&observations, size * obs_size)?;
+
+        py.allow_threads(|| {
+            let results: Vec<(f64, bool)> = self
+                .worlds
+                .par_iter_mut()
+                .zip(self.learners.par_iter())
+                .zip(actions.par_chunks(ACTION_SIZE))
+                .zip(active.par_iter().zip(observe.par_iter()))
+                .zip(observations.par_chunks_mut(obs_size))
+                .map(|((((world, learner), action), (active, observe)), observation)| {
+                    if *active == 0 {
+                        return (0.0, false);
+                    }
+
+                    let result = world.play_turn(action, *learner);
+                    if *observe != 0 || result.1 {
+                        world.observe(observation);
+                    }
+                    result
+                })
+                .collect();
+
+            for (i, (reward, done)) in results.into_iter().enumerate() {
+                rewards[i] = reward as f32;
+                dones[i] = done as u8;
+            }
+        });
+        Ok(())
+    }
+
+    /// `Utils.repeat_actions` for every world where `active` is set, with `actions`
+    /// (float32, `(len, num_players, 12)`) holding each world's seat actions, then
+    /// writes only the last observation. `rewards` and `dones` are written as in
+    /// `step_all`.
+    fn repeat_all(
+        &mut self,
+        py: Python,
+        actions: &PyAny,
+        active: &PyAny,
+        rounds: usize,
+        rewards: &PyAny,
+        dones: &PyAny,
+        observations: &PyAny,
+    ) -> PyResult<()> {
+        let size = self.worlds.len();
+        let seats = self.num_players() * ACTION_SIZE;
+        let (actions, active) = (PyBuffer::<f32>::get(actions)?, PyBuffer::<u8>::get(active)?);
+        let (rewards, dones) = (PyBuffer::<f32>::get(rewards)?, PyBuffer::<u8>::get(dones)?);
+        let observations = PyBuffer::<f32>::get(observations)?;
+
+        let actions = buffer_as_slice(&actions, size * seats)?;
+        let active = buffer_as_slice(&active, size)?;
+        let rewards = buffer_as_mut_slice(&rewards, size)?;
+        let dones = buffer_as_mut_slice(&dones, size)?;
+        let obs_size = self.obs_size();
+        let observations = buffer_as_mut_slice(&observations, size * obs_size)?;
+
+        py.allow_threads(|| {
+            let results: Vec<(f64, bool)> = self
+                .worlds
+                .par_iter_mut()
+                .zip(self.learners.par_iter())
+                .zip(actions.par_chunks(seats))
+                .zip(active.par_iter())
+                .zip(observations.par_chunks_mut(obs_size))
+                .map(|((((world, learner), actions), active), observation)| {
+                    if *active == 0 {
+                        return (0.0, false);
+                    }
+
+                    let result = world.play_rounds(actions, *learner, rounds);
+                    world.observe(observation);
+                    result
+                })
+                .collect();
+
+            for (i, (reward, done)) in results.into_iter().enumerate() {
+                rewards[i] = reward as f32;
+                dones[i] = done as u8;
+            }
+        });
+        Ok(())
+    }
+}
+
+impl WorldBatch {
+    fn check_index(&self, index: usize) -> PyResult<()> {
+        if index >= self.worlds.len() {
+            return Err(PyIndexError::new_err("world index out of range"));
+        }
+        Ok(())
     }
 }
 
@@ -634,5 +2377,552 @@ fn utils_rs(_py: Python, m: &PyModule) -> PyResult<()> {
     //let sys = _py.import("sys")?;
     //sys.setattr("stdout", LoggingStdout.into_py(_py))?;
     m.add_class::<Utils>()?;
+    m.add_class::<Snapshot>()?;
+    m.add_class::<WorldBatch>()?;
+    m.add("OBS_SIZE", OBS_SIZE)?;
+    m.add("OBS_FOV", OBS_FOV)?;
+    m.add("OBS_RAYS", OBS_RAYS)?;
+    m.add("MEMORY_SLOTS", MEMORY_SLOTS)?;
     Ok(())
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// xorshift64, so every run checks the same worlds.
+    struct Rng(u64);
+
+    impl Rng {
+        fn next(&mut self) -> u64 {
+            self.0 ^= self.0 << 13;
+            self.0 ^= self.0 >> 7;
+            self.0 ^= self.0 << 17;
+            self.0
+        }
+
+        fn below(&mut self, n: usize) -> usize {
+            (self.next() % n as u64) as usize
+        }
+
+        fn uniform(&mut self, lo: f64, hi: f64) -> f64 {
+            lo + (hi - lo) * ((self.next() >> 11) as f64 / (1u64 << 53) as f64)
+        }
+
+        /// A coordinate in `lo..hi`, often snapped to a whole or half unit so that
+        /// entities touch walls, cells and each other exactly.
+        fn coordinate(&mut self, lo: f64, hi: f64) -> f64 {
+            let v = self.uniform(lo, hi);
+            match self.below(5) {
+                0 => v.round(),
+                1 => v.round() + 0.5,
+                _ => v,
+            }
+        }
+    }
+
+    fn random_map(rng: &mut Rng, width: usize, height: usize) -> Vec<Vec<u8>> {
+        (0..height)
+            .map(|y| {
+                (0..width)
+                    .map(|x| {
+                        let border = x == 0 || y == 0 || x == width - 1 || y == height - 1;
+                        (border || rng.below(5) == 0) as u8
+                    })
+                    .collect()
+            })
+            .collect()
+    }
+
+    /// A match of up to 4 against 4 with smokes and flashbangs, opened or not, and
+    /// bullets around the players.
+    fn random_world(rng: &mut Rng) -> Utils {
+        let (width, height) = (8 + rng.below(20), 8 + rng.below(20));
+        let walls = random_map(rng, width, height);
+        let team_sizes = [1 + rng.below(4), 1 + rng.below(4)];
+        let mut utils = Utils::with_teams(walls, &team_sizes, None).unwrap();
+        let (w, h) = (width as f64, height as f64);
+
+        for i in 0..utils.players.len() {
+            for _ in 0..50 {
+                let (x, y) = (rng.coordinate(1.0, w - 2.0), rng.coordinate(1.0, h - 2.0));
+                if !utils.is_colliding_with_wall(x, y, 1, 1).0 {
+                    utils.players[i].x = x;
+                    utils.players[i].y = y;
+                    break;
+                }
+            }
+            utils.players[i].rotation = match rng.below(2) {
+                0 => 45.0 * rng.below(8) as f64,
+                _ => rng.uniform(0.0, 360.0),
+            };
+        }
+        for _ in 0..rng.below(7) {
+            let (x, y) = (rng.coordinate(1.0, w - 1.0), rng.coordinate(1.0, h - 1.0));
+            let opened = rng.below(3) > 0;
+            utils.smokes.push(Smoke { x, y, radius: utils.smokes_radius, rotation: 0.0, frames_moved: 0, opened, frames_opened: 0 });
+        }
+        for _ in 0..rng.below(7) {
+            let (x, y) = (rng.coordinate(1.0, w - 1.0), rng.coordinate(1.0, h - 1.0));
+            let opened = rng.below(3) > 0;
+            utils.flashes.push(Flashbang { x, y, rotation: 0.0, frames_moved: 0, opened, frames_opened: 0 });
+        }
+        for _ in 0..rng.below(100) {
+            let target = &utils.players[rng.below(utils.players.len())];
+            let (x, y) = match rng.below(2) {
+                0 => (target.x + rng.coordinate(-1.5, 1.5), target.y + rng.coordinate(-1.5, 1.5)),
+                _ => (rng.uniform(0.0, w), rng.uniform(0.0, h)),
+            };
+            let fired_by = rng.below(utils.players.len());
+            utils.bullets.push(Bullet { x, y, rotation: 0.0, fired_by });
+        }
+        utils.turn = rng.below(utils.players.len());
+        utils
+    }
+
+    /// `is_colliding_with_wall` as a scan of every cell of the map.
+    fn scan_walls(utils: &Utils, x: f64, y: f64, width: u8, height: u8) -> (bool, f64, f64) {
+        for (y2, row) in utils.map.walls.iter().enumerate() {
+            for (x2, &cell) in row.iter().enumerate() {
+                let (wall_x, wall_y) = (x2 as f64 * utils.wall_width as f64, y2 as f64 * utils.wall_height as f64);
+                if cell == 1 && utils.colliding(x, y, width, height, wall_x, wall_y, utils.wall_width, utils.wall_height) {
+                    return (true, x2 as f64, y2 as f64);
+                }
+            }
+        }
+        (false, 0.0, 0.0)
+    }
+
+    #[test]
+    fn wall_lookup_matches_full_scan() {
+        let mut rng = Rng(0x9e37_79b9_7f4a_7c15);
+        for _ in 0..100 {
+            let (width, height) = (3 + rng.below(20), 3 + rng.below(20));
+            let utils = Utils::with_teams(random_map(&mut rng, width, height), &[1, 1], None).unwrap();
+            for _ in 0..1000 {
+                let (x, y) = (rng.coordinate(-3.0, 25.0), rng.coordinate(-3.0, 25.0));
+                let (w, h) = (rng.below(4) as u8, rng.below(4) as u8);
+                assert_eq!(utils.is_colliding_with_wall(x, y, w, h), scan_walls(&utils, x, y, w, h), "box {x} {y} {w} {h}");
+            }
+            for v in [f64::NAN, f64::INFINITY, f64::NEG_INFINITY] {
+                assert_eq!(utils.is_colliding_with_wall(v, 1.0, 1, 1), scan_walls(&utils, v, 1.0, 1, 1));
+                assert_eq!(utils.is_colliding_with_wall(1.0, v, 1, 1), scan_walls(&utils, 1.0, v, 1, 1));
+            }
+        }
+    }
+
+    #[test]
+    fn grid_rays_match_scans() {
+        let mut rng = Rng(2222);
+        for _ in 0..300 {
+            let utils = random_world(&mut rng);
+            let grid = EntityGrid::new(&utils, true).unwrap();
+            let me = &utils.players[utils.turn];
+            for k in 0..100 {
+                let rotation = if k % 4 == 0 { 45.0 * k as f64 } else { rng.uniform(0.0, 360.0) };
+                let forward = utils.forward(rotation);
+
+                let scan = utils.trace_dda(me.x, me.y, forward, None, None);
+                let wall = utils.dda_wall(me.x, me.y, forward);
+                assert_eq!(utils.trace_dda(me.x, me.y, forward, None, Some(&grid)), scan, "rotation {rotation}");
+                assert_eq!(utils.trace_dda(me.x, me.y, forward, Some(wall), None), scan, "rotation {rotation}");
+                assert_eq!(utils.trace_dda(me.x, me.y, forward, Some(wall), Some(&grid)), scan, "rotation {rotation}");
+
+                if k % 4 == 0 {
+                    let scan = utils.trace_march(me.x, me.y, forward, None, None);
+                    assert_eq!(utils.trace_march(me.x, me.y, forward, None, Some(&grid)), scan, "rotation {rotation}");
+                }
+            }
+        }
+    }
+
+    #[test]
+    fn grid_hits_match_scans() {
+        let mut rng = Rng(3131);
+        for _ in 0..2000 {
+            let utils = random_world(&mut rng);
+            let grid = EntityGrid::new(&utils, false).unwrap();
+            assert_eq!(utils.players_hit(Some(&grid)), utils.players_hit(None));
+            assert_eq!(utils.shaping_reward(Some(&grid)), utils.shaping_reward(None));
+        }
+    }
+
+    /// The angles `ray_fov` cast at before fans were cached: the offsets summed step by
+    /// step until they cover `fov`.
+    fn summed_angles(rotation: f64, fov: f64, rays: f64) -> Vec<f64> {
+        let (mut angles, mut traveled, mut offset) = (vec![], 0.0, -fov / 2.0);
+        while traveled < fov {
+            angles.push(rotation + offset);
+            offset += fov / rays;
+            traveled += fov / rays;
+        }
+        angles
+    }
+
+    #[test]
+    fn fan_matches_per_ray_forward() {
+        let mut rng = Rng(4242);
+        let fans = [(OBS_FOV, OBS_RAYS as f64), (60.0, 64.0), (120.0, 90.0), (90.0, 7.0), (100.0, 33.3)];
+        for _ in 0..100 {
+            let mut utils = random_world(&mut rng);
+            for &(fov, rays) in &fans {
+                let fan = RayFan::new(fov, rays);
+                let me = &utils.players[utils.turn];
+                for rotation in [me.rotation, 225.0, rng.uniform(0.0, 360.0), rng.uniform(-1e3, 1e3)] {
+                    let angles = summed_angles(rotation, fov, rays);
+                    let directions: Vec<_> = fan.directions(rotation).collect();
+                    // The old loop could cast one extra ray; the fan casts ceil(rays).
+                    assert_eq!(directions.len(), ceil(rays) as usize);
+                    assert!(angles.len() - directions.len() <= 1);
+                    for (direction, &angle) in directions.iter().zip(&angles) {
+                        assert_eq!(*direction, utils.forward(angle), "fan {fov}/{rays} rotation {rotation}");
+                    }
+                }
+            }
+
+            if rng.below(2) == 0 {
+                utils.set_ray_engine("dda").unwrap();
+            }
+            let (x, y) = (utils.players[utils.turn].x, utils.players[utils.turn].y);
+            let traced: Vec<_> = summed_angles(utils.players[utils.turn].rotation, OBS_FOV, OBS_RAYS as f64)
+                .into_iter()
+                .map(|angle| utils.trace(x, y, angle))
+                .collect();
+            let flashed = utils.players[utils.turn].flashed || traced.iter().any(|hit| hit.2);
+            let cast = utils.cast_fov(OBS_FOV, OBS_RAYS as f64);
+            assert_eq!(cast, traced.iter().map(|hit| (hit.0, hit.1)).collect::<Vec<_>>());
+            assert_eq!(utils.players[utils.turn].flashed, flashed);
+        }
+    }
+
+    #[test]
+    fn cached_walls_match_uncached() {
+        let mut rng = Rng(1818);
+        let (mut casts, mut reused) = (0, 0);
+        for trial in 0..200 {
+            let mut utils = random_world(&mut rng);
+            if trial % 2 == 0 {
+                utils.set_ray_engine("dda").unwrap();
+            }
+            utils.parallel_rays = trial % 5 == 0;
+            for _ in 0..10 {
+                let mut uncached = utils.clone();
+                uncached.wall_cache = false;
+                let before = utils.wall_layers.get(utils.turn).cloned().flatten();
+                assert_eq!(utils.cast_fov(OBS_FOV, OBS_RAYS as f64), uncached.cast_fov(OBS_FOV, OBS_RAYS as f64));
+                assert_eq!(utils.players[utils.turn].flashed, uncached.players[uncached.turn].flashed);
+                let after = utils.wall_layers[utils.turn].clone().unwrap();
+                casts += 1;
+                reused += before.map_or(0, |before| Arc::ptr_eq(&before, &after) as usize);
+
+                // Everything else moves between casts; the caster only sometimes does.
+                let others = utils.players.len();
+                for i in (0..others).filter(|&i| i != utils.turn) {
+                    let (x, y) = (utils.players[i].x + rng.uniform(-0.7, 0.7), utils.players[i].y + rng.uniform(-0.7, 0.7));
+                    if !utils.is_colliding_with_wall(x, y, 1, 1).0 {
+                        utils.players[i].x = x;
+                        utils.players[i].y = y;
+                    }
+                }
+                for smoke in utils.smokes.iter_mut() {
+                    smoke.x += rng.uniform(-0.5, 0.5);
+                    smoke.opened = rng.below(3) > 0;
+                }
+                for flash in utils.flashes.iter_mut() {
+                    flash.y += rng.uniform(-0.5, 0.5);
+                    flash.opened = rng.below(3) > 0;
+                }
+                let me = utils.turn;
+                utils.players[me].flashed = false;
+                match rng.below(6) {
+                    0 => utils.players[me].rotation = rng.uniform(0.0, 360.0),
+                    1 => utils.players[me].x += rng.uniform(-0.3, 0.3),
+                    2 => utils.next_turn(),
+                    _ => {}
+                }
+            }
+        }
+        // Most casts came from an unchanged pose, so the cache was exercised.
+        assert!(reused * 3 > casts, "{reused} of {casts} casts reused their walls");
+    }
+
+    /// `march_wall` checking every step against the whole map, as before clearances.
+    fn stepped_march_wall(utils: &Utils, x: f64, y: f64, forward: (f64, f64)) -> (Option<f64>, usize) {
+        let (width, height) = (utils.map.zones.width as f64, utils.map.zones.height as f64);
+        let (mut x_cur, mut y_cur) = (x, y);
+        for steps in 1.. {
+            x_cur += forward.0;
+            y_cur += forward.1;
+            if (x_cur < -1.0 && forward.0 <= 0.0)
+                || (x_cur > width && forward.0 >= 0.0)
+                || (y_cur < -1.0 && forward.1 <= 0.0)
+                || (y_cur > height && forward.1 >= 0.0)
+            {
+                return (None, usize::MAX);
+            }
+            let (hit, wall_x, wall_y) = scan_walls(utils, x_cur, y_cur, 1, 1);
+            if hit {
+                return (Some(utils.distance(x, y, wall_x, wall_y)), steps);
+            }
+        }
+        unreachable!()
+    }
+
+    #[test]
+    fn march_with_clearance_matches_stepping() {
+        let mut rng = Rng(2020);
+        for _ in 0..300 {
+            let utils = random_world(&mut rng);
+            for k in 0..200 {
+                // From the players, and from anywhere in or around the map.
+                let (x, y) = match utils.players.get(k / 20) {
+                    Some(player) => (player.x, player.y),
+                    None => (rng.coordinate(-2.0, 30.0), rng.coordinate(-2.0, 30.0)),
+                };
+                let rotation = if k % 4 == 0 { 22.5 * k as f64 } else { rng.uniform(0.0, 360.0) };
+                let forward = utils.forward(rotation);
+                let wall = utils.march_wall(x, y, forward);
+                assert_eq!((wall.distance, wall.steps), stepped_march_wall(&utils, x, y, forward), "from {x} {y} rotation {rotation}");
+            }
+
+            // No point closer than its clearance to a spot collides with a wall.
+            for _ in 0..100 {
+                let (x, y) = (rng.coordinate(-2.0, 30.0), rng.coordinate(-2.0, 30.0));
+                let clearance = utils.map.zones.clearance(x, y).min(40.0);
+                if clearance <= 0.0 {
+                    continue;
+                }
+                for _ in 0..10 {
+                    let (angle, distance) = (rng.uniform(0.0, 360.0), rng.uniform(0.0, clearance - 1e-9));
+                    let (dx, dy) = utils.forward(angle);
+                    assert!(!scan_walls(&utils, x + dx * distance, y + dy * distance, 1, 1).0, "clearance {clearance} at {x} {y}");
+                }
+            }
+        }
+    }
+
+    /// Everything in `utils` that playing a match changes, flattened for comparing.
+    fn match_state(utils: &Utils) -> Vec<f64> {
+        let mut state = vec![utils.turn as f64];
+        for player in &utils.players {
+            state.extend(player.row());
+            state.extend([player.flashed_for as f64, player.team as f64, player.memory_values.len() as f64]);
+            state.extend(player.memory_values.iter().chain(&player.memory_keys));
+        }
+        for bullet in &utils.bullets {
+            state.extend(bullet.row());
+        }
+        for smoke in &utils.smokes {
+            state.extend(smoke.row());
+            state.extend([smoke.rotation, smoke.frames_moved as f64, smoke.frames_opened as f64]);
+        }
+        for flash in &utils.flashes {
+            state.extend(flash.row());
+            state.extend([flash.rotation, flash.frames_moved as f64, flash.frames_opened as f64]);
+        }
+        state
+    }
+
+    fn random_action(rng: &mut Rng) -> Vec<f32> {
+        (0..ACTION_SIZE).map(|_| rng.uniform(-100.0, 100.0) as f32).collect()
+    }
+
+    /// Plays up to `turns` random turns, stopping early if the match ends.
+    fn play_randomly(utils: &mut Utils, rng: &mut Rng, turns: usize) {
+        for _ in 0..turns {
+            if utils.play_turn(&random_action(rng), 0).1 {
+                break;
+            }
+        }
+    }
+
+    #[test]
+    fn reset_matches_new() {
+        let mut rng = Rng(2020_2020);
+        for trial in 0..200 {
+            // Big enough for the default spawns to be inside the walls.
+            let (width, height) = (11 + rng.below(10), 13 + rng.below(8));
+            let walls = random_map(&mut rng, width, height);
+            let team_sizes = [1 + rng.below(3), 1 + rng.below(3)];
+            let mut utils = Utils::with_teams(walls.clone(), &team_sizes, None).unwrap();
+            if trial % 2 == 0 {
+                utils.set_ray_engine("dda").unwrap();
+            }
+            utils.cast_fov(OBS_FOV, OBS_RAYS as f64);
+            let turns = rng.below(200);
+            play_randomly(&mut utils, &mut rng, turns);
+
+            let mut fresh = Utils::with_teams(walls, &team_sizes, None).unwrap();
+            let spawns = (trial % 3 == 0).then(|| {
+                let free: Vec<_> = (0..width * height)
+                    .map(|cell| ((cell % width) as f64, (cell / width) as f64))
+                    .filter(|&(x, y)| !fresh.is_colliding_with_wall(x, y, 1, 1).0)
+                    .collect();
+                (0..fresh.players.len()).map(|_| free[rng.below(free.len())]).collect::<Vec<_>>()
+            });
+            for (player, &(x, y)) in fresh.players.iter_mut().zip(spawns.iter().flatten()) {
+                player.x = x;
+                player.y = y;
+            }
+            utils.reset(spawns).unwrap();
+            assert_eq!(match_state(&utils), match_state(&fresh));
+
+            // The settings and caches kept across the reset do not change what is seen.
+            fresh.ray_engine = utils.ray_engine;
+            assert_eq!(utils.cast_fov(OBS_FOV, OBS_RAYS as f64), fresh.cast_fov(OBS_FOV, OBS_RAYS as f64));
+            play_randomly(&mut utils, &mut Rng(trial as u64 + 1), 50);
+            play_randomly(&mut fresh, &mut Rng(trial as u64 + 1), 50);
+            assert_eq!(match_state(&utils), match_state(&fresh));
+        }
+
+        let mut utils = Utils::with_teams(random_map(&mut rng, 8, 8), &[1, 1], None).unwrap();
+        assert!(utils.reset(Some(vec![(1.0, 1.0)])).is_err());
+        assert!(utils.reset(Some(vec![(0.0, 0.0), (1.0, 1.0)])).is_err());
+    }
+
+    #[test]
+    fn snapshots_restore_and_fork() {
+        let mut rng = Rng(2121_2121);
+        for trial in 0..100 {
+            let mut utils = random_world(&mut rng);
+            let turns = rng.below(60);
+            play_randomly(&mut utils, &mut rng, turns);
+            let start = match_state(&utils);
+            let snapshot = utils.snapshot();
+            let mut fork = utils.fork();
+
+            // The same turns from the same state play out the same, whichever world
+            // they are played in.
+            let seed = trial as u64 + 1;
+            play_randomly(&mut utils, &mut Rng(seed), 80);
+            let end = match_state(&utils);
+            let mut saved = Utils::with_teams(utils.walls(), &[1, 1], None).unwrap().snapshot();
+            utils.save_into(&mut saved);
+
+            utils.restore_from(&snapshot).unwrap();
+            assert_eq!(match_state(&utils), start);
+            play_randomly(&mut utils, &mut Rng(seed), 80);
+            assert_eq!(match_state(&utils), end);
+            play_randomly(&mut fork, &mut Rng(seed), 80);
+            assert_eq!(match_state(&fork), end);
+
+            let mut other = Utils::with_teams(utils.walls(), &[1, 1], None).unwrap();
+            other.restore_from(&saved).unwrap();
+            assert_eq!(match_state(&other), end);
+            let mut elsewhere = Utils::with_teams(random_map(&mut rng, 9, 9), &[1, 1], None).unwrap();
+            assert!(elsewhere.restore_from(&snapshot).is_err());
+        }
+    }
+
+    /// The bullet, smoke and flashbang ticks as they were before they worked in place:
+    /// each rebuilds its vector from the entities that survive.
+    fn rebuilt_ticks(utils: &mut Utils) {
+        let mut bullets = vec![];
+        for mut bullet in utils.bullets.clone() {
+            let forward = utils.forward(bullet.rotation);
+            bullet.x += forward.0;
+            bullet.y += forward.1;
+            if !utils.is_colliding_with_wall(bullet.x, bullet.y, 1, 1).0 {
+                bullets.push(bullet);
+            }
+        }
+        utils.bullets = bullets;
+
+        let mut smokes = vec![];
+        for mut smoke in utils.smokes.clone() {
+            if smoke.frames_moved < utils.smokes_max_move && !smoke.opened {
+                let forward = utils.forward(smoke.rotation);
+                smoke.frames_moved += 1;
+                smoke.x += forward.0;
+                smoke.y += forward.1;
+                if utils.is_smoke_colliding_with_wall(smoke.x, smoke.y, 0.1) {
+                    smoke.x -= forward.0;
+                    smoke.y -= forward.1;
+                    smoke.frames_moved = utils.smokes_max_move;
+                }
+            } else if smoke.opened {
+                smoke.frames_opened += 1;
+                if smoke.frames_opened > utils.smokes_max_open {
+                    continue;
+                }
+            } else {
+                smoke.opened = true;
+            }
+            smokes.push(smoke);
+        }
+        utils.smokes = smokes;
+
+        for player in utils.players.iter_mut().filter(|player| player.flashed) {
+            player.flashed_for += 1;
+            if player.flashed_for > utils.flash_blind {
+                player.flashed_for = 0;
+                player.flashed = false;
+            }
+        }
+        let mut flashes = vec![];
+        for mut flash in utils.flashes.clone() {
+            if flash.frames_moved < utils.flash_max_move && !flash.opened {
+                let forward = utils.forward(flash.rotation);
+                flash.frames_moved += 1;
+                flash.x += forward.0;
+                flash.y += forward.1;
+                if utils.is_colliding_with_wall(flash.x, flash.y, 1, 1).0 {
+                    flash.x -= forward.0;
+                    flash.y -= forward.1;
+                    flash.frames_moved = utils.flash_max_move;
+                }
+            } else if flash.opened {
+                flash.frames_opened += 1;
+                if flash.frames_opened > utils.flash_max_open {
+                    continue;
+                }
+            } else {
+                flash.opened = true;
+            }
+            flashes.push(flash);
+        }
+        utils.flashes = flashes;
+    }
+
+    #[test]
+    fn in_place_ticks_match_rebuilds() {
+        let mut rng = Rng(909);
+        for _ in 0..200 {
+            let mut utils = random_world(&mut rng);
+            // Some smokes clear within the test, and the thrown ones are part way through.
+            if rng.below(2) == 0 {
+                utils.smokes_max_open = 1 + rng.below(20) as u8;
+            }
+            for smoke in utils.smokes.iter_mut() {
+                smoke.frames_moved = rng.below(utils.smokes_max_move as usize + 1) as u8;
+                smoke.frames_opened = rng.below(utils.smokes_max_open as usize + 1) as u8;
+            }
+            for flash in utils.flashes.iter_mut() {
+                flash.frames_moved = rng.below(utils.flash_max_move as usize + 1) as u8;
+                flash.frames_opened = rng.below(utils.flash_max_open as usize + 1) as u8;
+            }
+            for _ in 0..40 {
+                // Everyone keeps throwing, so entities are always being added and dropped.
+                for i in 0..utils.players.len() {
+                    let player = &mut utils.players[i];
+                    player.rotation = rng.uniform(0.0, 360.0);
+                    (player.ammo, player.smokes, player.flashes) = (1, 1, 1);
+                    player.flashed |= rng.below(10) == 0;
+                    utils.turn = i;
+                    match rng.below(4) {
+                        0 => utils.fire_smoke(),
+                        1 => utils.fire_flash(),
+                        _ => utils.fire_bullet(),
+                    }
+                }
+
+                let mut rebuilt = utils.clone();
+                rebuilt_ticks(&mut rebuilt);
+                utils.tick_bullets();
+                utils.tick_smokes();
+                utils.tick_flashes();
+                assert_eq!(match_state(&utils), match_state(&rebuilt));
+            }
+        }
+    }
+}